@@ -1,5 +1,4 @@
-def tabulate(text):
-    return '\n'.join(['    ' + i for i in text.split('\n')])
+import io
 
 class Assignment:
     def __init__(self, op, lvalue, rvalue):
@@ -114,7 +113,7 @@ class DoWhile:
         self.statements = statements
 
     def __str__(self):
-        return "do\n{{\n{}\n}} while({})".format(tabulate(str(self.statements)), self.condition)
+        return _render(self)
 
 class EmptyStatement:
     def __str__(self):
@@ -128,7 +127,7 @@ class For:
         self.statements = statements
 
     def __str__(self):
-        return "for({};{};{})\n{{\n{}\n}}".format(self.initialize, self.condition, self.iterate, tabulate(str(self.statements)))
+        return _render(self)
 
 class FuncCall:
     def __init__(self, function, args):
@@ -146,7 +145,7 @@ class FuncDef:
         self.statements = statements
 
     def __str__(self):
-        return "{} {}({})\n{{\n{}\n}}".format(str(self.type), str(self.name), str(self.args), tabulate(str(self.statements)))
+        return _render(self)
 
 class Goto:
     def __init__(self, labelName):
@@ -169,16 +168,7 @@ class If:
         self.falseStatements = falseStatements
 
     def __str__(self):
-        returnStr = "if ({})\n{{\n{}\n}}".format(str(self.condition), tabulate(str(self.trueStatements)))
-
-        if self.falseStatements == None:
-            pass
-        elif len(self.falseStatements) == 1 and type(self.falseStatements[0]) == If:
-            returnStr += "\nelse {}".format(self.falseStatements[0])
-        else:
-            returnStr += "\nelse\n{{\n{}\n}}".format(tabulate(str(self.falseStatements)))
-
-        return returnStr
+        return _render(self)
 
 class Label:
     def __init__(self, name):
@@ -198,12 +188,7 @@ class Return:
 
 class Statements(list):
     def __str__(self):
-        temp = ""
-        if len(self) != 0:
-            temp = str(self[0]) + ("" if type(self[0]) in _noSemicolon else ";") 
-            for i in self[1:]:
-                temp += "\n" + str(i) + ("" if type(i) in _noSemicolon else ";")
-        return temp
+        return _render(self)
 
 class StructRef:
     def __init__(self, name, field):
@@ -246,7 +231,74 @@ class While:
         self.statements = statements
 
     def __str__(self):
-        return "while ({})\n{{\n{}\n}}".format(str(self.condition), tabulate(str(self.statements)))
+        return _render(self)
+
+# Writes the C source of ast nodes straight to a file or io buffer. Blocks
+# only bump the indent level, every newline written (including ones inside
+# expressions like string constants) is followed by the current indent, so
+# nested blocks are never re-indented
+class CWriter:
+    def __init__(self, file):
+        self.file = file
+        self.indent = ""
+
+    def write(self, text):
+        if len(self.indent) != 0 and "\n" in text:
+            text = text.replace("\n", "\n" + self.indent)
+        self.file.write(text)
+
+    # Writes "{", the statements one level deeper, then "}" each on their own line
+    def writeBlock(self, statements):
+        self.write("\n{")
+        self.indent += "    "
+        self.write("\n")
+        self.writeNode(statements)
+        self.indent = self.indent[:-4]
+        self.write("\n}")
+
+    def writeStatements(self, statements):
+        for i, statement in enumerate(statements):
+            if i != 0:
+                self.write("\n")
+            self.writeNode(statement)
+            if not type(statement) in _noSemicolon:
+                self.write(";")
+
+    def writeNode(self, node):
+        nodeType = type(node)
+        if nodeType == Statements:
+            self.writeStatements(node)
+        elif nodeType == FuncDef:
+            self.write("{} {}({})".format(str(node.type), str(node.name), str(node.args)))
+            self.writeBlock(node.statements)
+        elif nodeType == If:
+            self.write("if ({})".format(str(node.condition)))
+            self.writeBlock(node.trueStatements)
+            if node.falseStatements == None:
+                pass
+            elif len(node.falseStatements) == 1 and type(node.falseStatements[0]) == If:
+                self.write("\nelse ")
+                self.writeNode(node.falseStatements[0])
+            else:
+                self.write("\nelse")
+                self.writeBlock(node.falseStatements)
+        elif nodeType == While:
+            self.write("while ({})".format(str(node.condition)))
+            self.writeBlock(node.statements)
+        elif nodeType == DoWhile:
+            self.write("do")
+            self.writeBlock(node.statements)
+            self.write(" while({})".format(node.condition))
+        elif nodeType == For:
+            self.write("for({};{};{})".format(node.initialize, node.condition, node.iterate))
+            self.writeBlock(node.statements)
+        else:
+            self.write(str(node))
+
+def _render(node):
+    buffer = io.StringIO()
+    CWriter(buffer).writeNode(node)
+    return buffer.getvalue()
 
 _parenthesisTypes = [BinaryOp, TernaryOp, Assignment]
 _noSemicolon = [While, For, If, Comment]
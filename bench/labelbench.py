@@ -0,0 +1,50 @@
+#**************************************************************************#
+# This file is part of pymsc which is released under MIT License. See file #
+# LICENSE or go to https://github.com/jam1garner/pymsc/blob/master/LICENSE #
+# for full license details.                                                #
+#**************************************************************************#
+# Times disasm() on a single synthetic function made of BRANCHES if blocks,
+# so it has that many jumps and jump labels to merge into the script. The
+# time per branch should stay flat as the function grows.
+# usage: python bench/labelbench.py [BRANCHES ...]   (default: 5000 20000 50000)
+import os, sys, tempfile, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msc import Assembler, MscFile, MscScript, disassembleCommands
+from disasmlib import disasm, Label
+
+# One function of branchCount "if (var0) var1 = i;" blocks
+def makeFile(branchCount):
+    lines = ['begin 0, 2']
+    for i in range(branchCount):
+        lines.append('pushVar. 0, 0')
+        lines.append('ifNot end_%d' % i)
+        lines.append('pushInt. %d' % i)
+        lines.append('setVar 0, 1')
+        lines.append('end_%d:' % i)
+    lines.append('return_9')
+    code = bytes(Assembler().assemble('\n'.join(lines)))
+    script = MscScript()
+    script.cmds = disassembleCommands(code, 0)
+    script.bounds = [0, len(code)]
+    mscFile = MscFile()
+    mscFile.scripts.append(script)
+    return bytes(mscFile.write()), len(script.cmds)
+
+def main(branchCounts):
+    with tempfile.TemporaryDirectory() as tmp:
+        for branchCount in branchCounts:
+            data, commandCount = makeFile(branchCount)
+            path = os.path.join(tmp, 'branches_%d.mscsb' % branchCount)
+            with open(path, 'wb') as f:
+                f.write(data)
+            result = [None]
+            def run():
+                result[0] = disasm(path)
+            elapsed = min(timeit.repeat(run, number=1, repeat=3))
+            labelCount = sum(1 for cmd in result[0][0].cmds if type(cmd) == Label)
+            print("{:6} branches ({} commands, {} labels): disasm {:.3f} s, {:.2f} us per branch".format(
+                branchCount, commandCount, labelCount, elapsed, elapsed / branchCount * 1e6))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main([int(n) for n in sys.argv[1:]] or [5000, 20000, 50000]))
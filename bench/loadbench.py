@@ -0,0 +1,65 @@
+#**************************************************************************#
+# This file is part of pymsc which is released under MIT License. See file #
+# LICENSE or go to https://github.com/jam1garner/pymsc/blob/master/LICENSE #
+# for full license details.                                                #
+#**************************************************************************#
+# Times MscFile.readFromFile on synthetic files of many tiny scripts (and
+# as many strings), which is where building the offset/string tables and
+# the script bounds dominates loading. Time per script should stay flat.
+# Files or directories given after --files are timed as well.
+# usage: python bench/loadbench.py [SCRIPTS ...] [--files FILE_OR_DIR ...]
+#        (default: 2000 8000 32000)
+import os, sys, tempfile, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msc import MscFile, MscScript, Command
+
+# scriptCount scripts of "begin 0, 0; return_9" listed in reverse order in
+# the entry table, plus one string per script
+def makeFile(scriptCount):
+    mscFile = MscFile()
+    for i in range(scriptCount):
+        script = MscScript()
+        script.cmds = [Command(0x2, [0, 0]), Command(0x9)]
+        script.bounds = [i * 6, i * 6 + 6]
+        mscFile.scripts.append(script)
+        mscFile.strings.append('string %d' % i)
+    mscFile.stringSize = 0x10
+    data = mscFile.write()
+    # Reverse the entry table so the loader has to sort the script bounds
+    entriesOffset = 0x30 + scriptCount * 6
+    entriesOffset += (-entriesOffset) % 0x10
+    entries = data[entriesOffset:entriesOffset + scriptCount * 4]
+    data[entriesOffset:entriesOffset + scriptCount * 4] = b''.join(reversed([entries[i:i + 4] for i in range(0, len(entries), 4)]))
+    return bytes(data)
+
+def timeLoad(path):
+    def load():
+        with open(path, 'rb') as f:
+            MscFile().readFromFile(f)
+    return min(timeit.repeat(load, number=1, repeat=5))
+
+def main(argv):
+    files = []
+    if '--files' in argv:
+        files = argv[argv.index('--files') + 1:]
+        argv = argv[:argv.index('--files')]
+    scriptCounts = [int(n) for n in argv] or ([2000, 8000, 32000] if len(files) == 0 else [])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for scriptCount in scriptCounts:
+            path = os.path.join(tmp, 'scripts_%d.mscsb' % scriptCount)
+            with open(path, 'wb') as f:
+                f.write(makeFile(scriptCount))
+            elapsed = timeLoad(path)
+            print("{:6} scripts: {:.1f} ms, {:.2f} us per script".format(scriptCount, elapsed * 1000, elapsed / scriptCount * 1e6))
+
+    for path in files:
+        paths = [path]
+        if os.path.isdir(path):
+            paths = [os.path.join(root, name) for root, dirs, names in os.walk(path) for name in sorted(names) if name.lower().endswith('.mscsb')]
+        for p in paths:
+            print("{}: {:.1f} ms".format(p, timeLoad(p) * 1000))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,127 @@
+#**************************************************************************#
+# This file is part of pymsc which is released under MIT License. See file #
+# LICENSE or go to https://github.com/jam1garner/pymsc/blob/master/LICENSE #
+# for full license details.                                                #
+#**************************************************************************#
+# Stress test for the walk states emuScript shares between endPositions:
+# builds a staircase of STEPS loops where each loop jumps back from inside
+# the next one (so the back-edges cross), and each step holds loops nested
+# DEPTH deep. Checks that
+#   - getBlocks' lowestIndex is what repeating the backward pass over every
+#     jump target until nothing changes gives
+#   - disassembling gives the same commands and scriptCalledVars as a walk
+#     sharing no states between endPositions
+# usage: python bench/nestedloops.py [STEPSxDEPTH ...]   (default: 8x3 32x3 16x6)
+import os, sys, tempfile, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msc import Assembler, MscFile, MscScript, disassembleCommands
+from disasmlib import Disassembler
+
+# Walks every endPosition on its own, as a reference
+class UnsharedDisassembler(Disassembler):
+    def getBlocks(self, script):
+        blockStarts, lowestIndex = Disassembler.getBlocks(self, script)
+        return blockStarts, [0] * len(lowestIndex)
+
+# Loops nested depth deep, each picking the callee or 0 for var1 and calling it
+def nestedSource(lines, depth, callee):
+    n = len(lines)
+    lines.append('loop_%d:' % n)
+    lines.append('pushVar. 0, %d' % (depth % 3))
+    lines.append('ifNot done_%d' % n)
+    lines.append('pushVar. 0, 2')
+    lines.append('ifNot zero_%d' % n)
+    lines.append('pushInt. %d' % callee)
+    lines.append('else set_%d' % n)
+    lines.append('zero_%d:' % n)
+    lines.append('pushInt. 0')
+    lines.append('set_%d:' % n)
+    lines.append('setVar 0, 1')
+    if depth > 0:
+        nestedSource(lines, depth - 1, callee)
+    lines.append('pushVar. 0, 1')
+    lines.append('callFunc 0')
+    lines.append('jump loop_%d' % n)
+    lines.append('done_%d:' % n)
+
+def mainSource(steps, depth, callee):
+    lines = ['begin 0, 3']
+    for step in range(steps):
+        lines.append('step_%d:' % step)
+        nestedSource(lines, depth, callee)
+        if step > 0:
+            lines.append('pushVar. 0, 0')
+            lines.append('if step_%d' % (step - 1))
+    lines.append('pushVar. 0, 0')
+    lines.append('if step_%d' % (steps - 1))
+    lines.append('return_9')
+    return '\n'.join(lines)
+
+# The staircase function followed by the empty function it calls
+def makeFile(steps, depth):
+    calleeStart = len(Assembler().assemble(mainSource(steps, depth, 0)))
+    mscFile = MscFile()
+    for source, start in [(mainSource(steps, depth, calleeStart), 0), ('begin 0, 0\nreturn_9', calleeStart)]:
+        code = bytes(Assembler().assemble(source))
+        script = MscScript()
+        script.cmds = disassembleCommands(code, start)
+        script.bounds = [start, start + len(code)]
+        mscFile.scripts.append(script)
+    return bytes(mscFile.write()), len(mscFile.scripts[0].cmds)
+
+# lowestIndex by repeating the backward pass until nothing changes
+def fixpointLowestIndex(script):
+    cmds = script.cmds
+    lowestIndex = list(range(len(cmds) + 1))
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(cmds) - 1, -1, -1):
+            lowest = min(lowestIndex[i], lowestIndex[i + 1])
+            if cmds[i].command in [4, 5, 0x36, 0x34, 0x35]:
+                target = script.getIndexOfInstruction(cmds[i].parameters[0])
+                if target != None:
+                    lowest = min(lowest, lowestIndex[target])
+            if lowest != lowestIndex[i]:
+                lowestIndex[i] = lowest
+                changed = True
+    return lowestIndex
+
+def disassemble(cls, path):
+    disassembler = cls()
+    mscFile = disassembler.disasm(path)
+    return str(mscFile), {name: sorted(v) for name, v in disassembler.scriptCalledVars.items()}
+
+def main(sizes):
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            steps, depth = [int(n) for n in size.split('x')]
+            data, commandCount = makeFile(steps, depth)
+            path = os.path.join(tmp, 'loops_%s.mscsb' % size)
+            with open(path, 'wb') as f:
+                f.write(data)
+            errors = []
+            mscFile = MscFile()
+            with open(path, 'rb') as f:
+                mscFile.readFromFile(f)
+            _, lowestIndex = Disassembler().getBlocks(mscFile.scripts[0])
+            if lowestIndex != fixpointLowestIndex(mscFile.scripts[0]):
+                errors.append("lowestIndex misses indexes reachable through several jumps")
+            result = [None]
+            def run():
+                result[0] = disassemble(Disassembler, path)
+            elapsed = min(timeit.repeat(run, number=1, repeat=3))
+            start = timeit.default_timer()
+            reference = disassemble(UnsharedDisassembler, path)
+            referenceElapsed = timeit.default_timer() - start
+            if result[0] != reference:
+                errors.append("disassembly differs from walking every endPosition on its own")
+            print("{} {:5}: {} commands, disasm {:.3f} s ({:.3f} s without shared states){}".format(
+                'OK    ' if len(errors) == 0 else 'FAILED', size, commandCount, elapsed,
+                referenceElapsed, '' if len(errors) == 0 else ': ' + ', '.join(errors)))
+            failed += len(errors) != 0
+    return 1 if failed > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:] or ['8x3', '32x3', '16x6']))
@@ -0,0 +1,100 @@
+#**************************************************************************#
+# This file is part of pymsc which is released under MIT License. See file #
+# LICENSE or go to https://github.com/jam1garner/pymsc/blob/master/LICENSE #
+# for full license details.                                                #
+#**************************************************************************#
+# Checks and times MscFile.write on real files:
+#   - every file read (plain, packed and lazy) and written back must come out
+#     byte for byte the same
+#   - after growing the first script, every jump, the entry point and every
+#     pushInt/pushShort of a script start must follow the scripts that moved
+# usage: python bench/roundtrip.py FILE_OR_DIR [FILE_OR_DIR ...]
+import os, sys, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msc import MscFile, Command, JUMP_COMMANDS, PUSH_CONSTANT_COMMANDS
+
+def collectFiles(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files += [os.path.join(root, name) for name in sorted(names) if name.lower().endswith('.mscsb')]
+        else:
+            files.append(path)
+    return files
+
+def readFile(path, **kwargs):
+    mscFile = MscFile()
+    with open(path, 'rb') as f:
+        mscFile.readFromFile(f, **kwargs)
+    return mscFile
+
+def checkRoundTrip(path, raw):
+    for mode, kwargs in [('plain', {}), ('packed', {'packed': True}), ('lazy', {'lazy': True})]:
+        out = readFile(path, **kwargs).write()
+        if bytes(out) != raw:
+            return "{} read writes {} bytes differing from the {} read".format(mode, len(out), len(raw))
+    return None
+
+# Appends a nop to the first non-empty script so every script after it moves
+# by one byte, then checks the rewritten file against the original
+def checkRelocation(path, raw):
+    original = MscFile().readFromBytes(raw, '<')
+    grown = MscFile().readFromBytes(raw, '<')
+    k = next((i for i, script in enumerate(grown) if len(script) != 0), None)
+    if k == None:
+        return None
+    grown[k].cmds.append(Command(0x0, [], False))
+    rewritten = MscFile().readFromBytes(bytes(grown.write()), '<')
+
+    def newPosition(position):
+        number = original.getScriptNumberAtLocation(position)
+        if number == None or number <= k:
+            return position
+        return position + 1
+
+    starts = set(script.bounds[0] for script in original if len(script) != 0)
+    if rewritten.entryPoint != newPosition(original.entryPoint):
+        return "entry point 0x{:X} not relocated".format(original.entryPoint)
+    for i, (before, after) in enumerate(zip(original, rewritten)):
+        for old, new in zip(before.cmds, after.cmds):
+            expected = old.parameters
+            if old.command in JUMP_COMMANDS:
+                expected = [newPosition(old.parameters[0])]
+            elif old.command in PUSH_CONSTANT_COMMANDS and old.parameters[0] in starts:
+                expected = [newPosition(old.parameters[0])]
+            if (old.command, expected) != (new.command, new.parameters):
+                return "script {} command at 0x{:X}: expected {} {}, got {} {}".format(
+                    i, old.commandPosition, old.command, expected, new.command, new.parameters)
+    return None
+
+def main(paths):
+    files = collectFiles(paths)
+    failed = 0
+    totalRead = 0
+    totalWrite = 0
+    totalSize = 0
+    for path in files:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        error = checkRoundTrip(path, raw) or checkRelocation(path, raw)
+        if error != None:
+            print("FAILED  {}: {}".format(path, error))
+            failed += 1
+            continue
+        mscFile = readFile(path)
+        totalRead += min(timeit.repeat(lambda: readFile(path), number=1, repeat=3))
+        totalWrite += min(timeit.repeat(mscFile.write, number=1, repeat=3))
+        totalSize += len(raw)
+    print("{}/{} files round-tripped and relocated".format(len(files) - failed, len(files)))
+    if totalWrite > 0:
+        print("{:.1f} KiB: read {:.3f} s, write {:.3f} s ({:.1f} MiB/s)".format(
+            totalSize / 1024, totalRead, totalWrite, totalSize / (1 << 20) / totalWrite))
+    return 1 if failed > 0 else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python bench/roundtrip.py FILE_OR_DIR [FILE_OR_DIR ...]", file=sys.stderr)
+        sys.exit(2)
+    sys.exit(main(sys.argv[1:]))
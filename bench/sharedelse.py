@@ -0,0 +1,92 @@
+#**************************************************************************#
+# This file is part of pymsc which is released under MIT License. See file #
+# LICENSE or go to https://github.com/jam1garner/pymsc/blob/master/LICENSE #
+# for full license details.                                                #
+#**************************************************************************#
+# Stress test for shared else blocks: builds chains of WIDTH ifs that all
+# jump to one else, whose body is another such chain, DEPTH levels deep.
+# Structuring has to reuse the shared regions, so the number of
+# pullOutGroups calls must stay linear in the size of the function even
+# though the C output repeats every else body.
+# usage: python bench/sharedelse.py [DEPTHxWIDTH ...]   (default: 4x3 8x3 6x5)
+import os, sys, tempfile, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from msc import Assembler, MscFile, MscScript, disassembleCommands
+import mscdec
+
+# Assembly of one level of the chain, the leaf sets var1 to 100
+def chainSource(lines, depth, width, labelNumber=0):
+    elseLabel = 'else_%d' % labelNumber
+    endLabel = 'end_%d' % labelNumber
+    for i in range(width):
+        lines.append('pushVar. 0, %d' % (i % 3))
+        lines.append('ifNot ' + elseLabel)
+    lines.append('pushInt. %d' % depth)
+    lines.append('setVar 0, 0')
+    lines.append('else ' + endLabel)
+    lines.append(elseLabel + ':')
+    if depth > 0:
+        chainSource(lines, depth - 1, width, labelNumber + 1)
+    else:
+        lines.append('pushInt. 100')
+        lines.append('setVar 0, 1')
+    lines.append(endLabel + ':')
+    lines.append('nop')
+
+# A single function MSC file holding the chain
+def makeFile(depth, width):
+    lines = ['begin 0, 3']
+    chainSource(lines, depth, width)
+    lines.append('return_9')
+    code = bytes(Assembler().assemble('\n'.join(lines)))
+    script = MscScript()
+    script.cmds = disassembleCommands(code, 0)
+    script.bounds = [0, len(code)]
+    mscFile = MscFile()
+    mscFile.scripts.append(script)
+    return bytes(mscFile.write()), len(script.cmds)
+
+# Decompiles the file, returns (C text, pullOutGroups calls, seconds)
+def decompileCounted(path):
+    pullOutGroups = mscdec.pullOutGroups
+    calls = [0]
+    def countedPullOutGroups(*args, **kwargs):
+        calls[0] += 1
+        return pullOutGroups(*args, **kwargs)
+    mscdec.pullOutGroups = countedPullOutGroups
+    try:
+        start = timeit.default_timer()
+        session = mscdec.DecompilerSession()
+        session.decompileFile(path)
+        text, _ = session.renderC()
+        elapsed = timeit.default_timer() - start
+    finally:
+        mscdec.pullOutGroups = pullOutGroups
+    return text, calls[0], elapsed
+
+def main(sizes):
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            depth, width = [int(n) for n in size.split('x')]
+            data, commandCount = makeFile(depth, width)
+            path = os.path.join(tmp, 'shared_%s.mscsb' % size)
+            with open(path, 'wb') as f:
+                f.write(data)
+            text, calls, elapsed = decompileCounted(path)
+            # Every if of a level reaches the next level's else body, so the
+            # leaf is written once per path through the chain
+            leaves = text.count('var1 = 0x64;')
+            errors = []
+            if calls > commandCount:
+                errors.append("{} pullOutGroups calls for {} commands".format(calls, commandCount))
+            if leaves != width ** (depth + 1):
+                errors.append("leaf written {} times instead of {}".format(leaves, width ** (depth + 1)))
+            print("{} {:5}: {} commands, {} pullOutGroups calls, {} lines of C in {:.3f} s{}".format(
+                'OK    ' if len(errors) == 0 else 'FAILED', size, commandCount, calls,
+                text.count('\n'), elapsed, '' if len(errors) == 0 else ': ' + ', '.join(errors)))
+            failed += len(errors) != 0
+    return 1 if failed > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:] or ['4x3', '8x3', '6x5']))
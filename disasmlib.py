@@ -5,14 +5,11 @@
 #**************************************************************************#
 from msc import *
 import sys, os, time, os.path, timeit
+from collections import deque
 from argparse import ArgumentParser
 from struct import unpack, pack
 from math import isnan
 
-scriptNames = {}
-scriptOffsets = []
-scriptCalls = {}
-
 gvIsOffset = [False for i in range(64)]
 for gv in [7] + list(range(11,17)) + [21,22,23,25,26,27,28,30,34,35,36,37,39,40,41,42,43,44,56,57,58,59,60,61]:
     gvIsOffset[gv] = True
@@ -30,126 +27,6 @@ class Label:
 class ScriptRef(str):
     pass
 
-def updateScriptReference(popped, index, scriptName):
-    global scriptCalledVars, mscFile, acmdNames, charAcmdNames
-    try:
-        #if the Xth command popped off the stack is pushing a constant
-        if popped[index].command in [0xA, 0xD]:
-            #if the index pushed is a valid script offset
-            if popped[index].parameters[0] in scriptOffsets:
-                newScriptName = scriptNames[popped[index].parameters[0]]
-                popped[index].parameters[0] = ScriptRef(newScriptName)
-
-        #if the Xth command popped off the stack is a variable
-        if popped[index].command == 0xB:
-            #if the variable is local
-            if popped[index].parameters[0] == 0:
-                if not scriptName in scriptCalledVars:
-                    scriptCalledVars[scriptName] = []
-                if not popped[index].parameters[1] in scriptCalledVars[scriptName]:
-                    scriptCalledVars[scriptName].append(popped[index].parameters[1])
-    except:
-        print(scriptName)
-        raise
-
-#script - mscScript object
-#startIndex - index in the script to start at, used for recursively evaluating all paths
-#stack - the current stack, blank at start of script and passed through recursively when evaluating paths
-#endPosition - when to stop searching (i.e. when the stack is empty and paths recombine)
-#depth - used to determine whether or not a path can be abandoned
-def emuScript(script, startIndex, stack, passCount, endPosition=None, depth=0):
-    global clearedPaths,scriptCalledVars, mscFile
-    scriptName = scriptNames[script.bounds[0]]
-    if endPosition == None:
-        clearedPaths = []
-    try:
-        i = startIndex
-        while i < len(script):
-            if endPosition != None and i >= endPosition and len(stack) == 0:
-                return False
-            #Get the number of pops based on the command and it's parameters
-            popCount = COMMAND_STACKPOPS[script[i].command](script[i].parameters)
-            popped = []
-            try:
-                for _ in range(popCount):
-                    #Pop the needed commands into the popped list in case one of them is needed
-                    popped.append(stack.pop())
-            except:
-                pass
-
-            #First pass
-            if passCount == 0:
-                #if the command is a function call
-                if script[i].command in [0x2f, 0x30, 0x31]:
-                    updateScriptReference(popped, 0, scriptName)
-                #if the command is a printf
-                if script[i].command == 0x2c and popped[-1].command in [0xA, 0xD]:
-                    if type(popped[-1].parameters[0]) != str:
-                        popped[-1].parameters[0] = mscFile.strings[popped[-1].parameters[0]]
-                #if the command in a sys call
-                if script[i].command == 0x2d:
-                    if script[i].parameters[1] == 0:
-                        updateScriptReference(popped, 0, scriptName)
-                    elif script[i].parameters[1] == 3:
-                        updateScriptReference(popped, 0, scriptName)
-                    elif script[i].parameters[1] == 0x29:
-                        updateScriptReference(popped, 1, scriptName)
-                    elif script[i].parameters[1] == 0x29:
-                        updateScriptReference(popped, 2, scriptName)
-                #If gv16 flag is enabled and it is setting GlobalVar16
-                if script[i].command == 0x1C and script[i].parameters[0] == 0x1 and gvIsOffset[script[i].parameters[1]]:
-                    updateScriptReference(popped, 0, scriptName)
-            elif passCount >= 1:
-                if script[i].command in [0x1C, 0x41] and scriptName in scriptCalledVars:
-                    if script[i].parameters[0] == 0 and script[i].parameters[1] in scriptCalledVars[scriptName]:
-                        updateScriptReference(popped, 0, scriptName)
-                if script[i].command in [0x2f, 0x30, 0x31]:
-                    if popped[0].command in [0xA, 0xD]:
-                        jumpScriptName = None
-                        if isinstance(popped[0].parameters[0], int) and popped[0].parameters[0] in scriptNames:
-                            jumpScriptName = scriptNames[popped[0].parameters[0]]
-                        elif isinstance(popped[0].parameters[0], str):
-                            jumpScriptName = popped[0].parameters[0]
-
-                        if jumpScriptName in scriptCalledVars:
-                            for localVarNum in scriptCalledVars[jumpScriptName]:
-                                if localVarNum+1 < len(popped):
-                                    updateScriptReference(popped, -(localVarNum + 1), scriptName)
-
-            #if the command is push, just readd the command before it
-            if script[i].command == 0x32:
-                stack.append(script[i-1])
-            #if the pushBit is set, push the command onto the stack
-            if script[i].pushBit:
-                stack.append(script[i])
-            #if the command is if or ifNot then evaluate both possible paths
-            if script[i].command in [0x34, 0x35]:
-                jumpIndex = script.getIndexOfInstruction(script[i].parameters[0])
-                endOfBlock = jumpIndex
-                if script[jumpIndex - 1].command in [4, 5, 0x36]:
-                    endOfBlock = script.getIndexOfInstruction(script[jumpIndex - 1].parameters[0])
-                    finished = emuScript(script, jumpIndex, stack, passCount, endOfBlock, depth+1)
-                elif len(stack) > 0:
-                    finished = emuScript(script, jumpIndex, stack, passCount, jumpIndex, depth+1)
-                if not script[i].commandPosition in clearedPaths:
-                    clearedPaths.append(script[i].commandPosition)
-                else:
-                    if depth != 0:
-                        pass#return
-            #if it hits a jump or else command, just jump it
-            if script[i].command in [4, 5, 0x36]:
-                newIndex = script.getIndexOfInstruction(script[i].parameters[0])
-                if newIndex == None:
-                    i += 1
-                else:
-                    i = newIndex
-            else:
-                #if it isn't a jump, move on to the next command
-                i += 1
-    except:
-        raise
-    return True
-
 def guessIsFloat(bits):
     if bits == 0:
         return False
@@ -189,46 +66,285 @@ def pickTypes(script):
                     if not (asFloat > 0 and asFloat < 0.000001):
                         cmd.parameters[0] = asFloat
 
+# Holds the cross-script analysis state for one MSC file so several files
+# can be disassembled side by side without sharing tables
+class Disassembler:
+    def __init__(self):
+        self.scriptNames = {}
+        self.scriptOffsets = []
+        self.scriptCalledVars = {}
+        self.calledVarsCount = 0
+        self.scriptCallers = {}
+        self.mscFile = None
+
+    def updateScriptReference(self, popped, index, scriptName):
+        try:
+            #if the Xth command popped off the stack is pushing a constant
+            if popped[index].command in [0xA, 0xD]:
+                #if the index pushed is a valid script offset
+                if popped[index].parameters[0] in self.scriptNames:
+                    newScriptName = self.scriptNames[popped[index].parameters[0]]
+                    popped[index].parameters[0] = ScriptRef(newScriptName)
+
+            #if the Xth command popped off the stack is a variable
+            if popped[index].command == 0xB:
+                #if the variable is local
+                if popped[index].parameters[0] == 0:
+                    if not scriptName in self.scriptCalledVars:
+                        self.scriptCalledVars[scriptName] = []
+                    if not popped[index].parameters[1] in self.scriptCalledVars[scriptName]:
+                        self.scriptCalledVars[scriptName].append(popped[index].parameters[1])
+                        self.calledVarsCount += 1
+        except:
+            print(scriptName)
+            raise
+
+    # Applies what cmd tells about the commands it popped off the stack:
+    # script offsets pushed as constants become ScriptRefs, printf format
+    # strings get resolved and local variables passed to or set from script
+    # references are remembered in scriptCalledVars
+    def emuCommand(self, cmd, popped, passCount, scriptName):
+        #First pass
+        if passCount == 0:
+            #if the command is a function call
+            if cmd.command in [0x2f, 0x30, 0x31]:
+                self.updateScriptReference(popped, 0, scriptName)
+                #remember who calls what for passing on scriptCalledVars
+                jumpScriptName = self.getJumpScriptName(popped)
+                if jumpScriptName != None:
+                    self.scriptCallers.setdefault(jumpScriptName, set()).add(scriptName)
+            #if the command is a printf
+            if cmd.command == 0x2c and popped[-1].command in [0xA, 0xD]:
+                if type(popped[-1].parameters[0]) != str:
+                    popped[-1].parameters[0] = self.mscFile.strings[popped[-1].parameters[0]]
+            #if the command in a sys call
+            if cmd.command == 0x2d:
+                if cmd.parameters[1] == 0:
+                    self.updateScriptReference(popped, 0, scriptName)
+                elif cmd.parameters[1] == 3:
+                    self.updateScriptReference(popped, 0, scriptName)
+                elif cmd.parameters[1] == 0x29:
+                    self.updateScriptReference(popped, 1, scriptName)
+                elif cmd.parameters[1] == 0x29:
+                    self.updateScriptReference(popped, 2, scriptName)
+            #If gv16 flag is enabled and it is setting GlobalVar16
+            if cmd.command == 0x1C and cmd.parameters[0] == 0x1 and gvIsOffset[cmd.parameters[1]]:
+                self.updateScriptReference(popped, 0, scriptName)
+        elif passCount >= 1:
+            if cmd.command in [0x1C, 0x41] and scriptName in self.scriptCalledVars:
+                if cmd.parameters[0] == 0 and cmd.parameters[1] in self.scriptCalledVars[scriptName]:
+                    self.updateScriptReference(popped, 0, scriptName)
+            if cmd.command in [0x2f, 0x30, 0x31]:
+                jumpScriptName = self.getJumpScriptName(popped)
+                if jumpScriptName in self.scriptCalledVars:
+                    for localVarNum in self.scriptCalledVars[jumpScriptName]:
+                        if localVarNum+1 < len(popped):
+                            self.updateScriptReference(popped, -(localVarNum + 1), scriptName)
+
+    # Name of the script a call jumps to when its address was pushed as a
+    # constant, None otherwise
+    def getJumpScriptName(self, popped):
+        if len(popped) > 0 and popped[0].command in [0xA, 0xD]:
+            if isinstance(popped[0].parameters[0], int) and popped[0].parameters[0] in self.scriptNames:
+                return self.scriptNames[popped[0].parameters[0]]
+            elif isinstance(popped[0].parameters[0], str):
+                return popped[0].parameters[0]
+        return None
+
+    # Returns the indexes a walk can arrive at other than by falling through
+    # (jump and branch targets and the instruction after each branch), and
+    # for each index the lowest index a walk from there can still get to,
+    # following any number of jumps back
+    def getBlocks(self, script):
+        cmds = script.cmds
+        blockStarts = set()
+        # The indexes a walk can go to each index from
+        predecessors = [[] for _ in range(len(cmds) + 1)]
+        for i, cmd in enumerate(cmds):
+            predecessors[i + 1].append(i)
+            if cmd.command in [4, 5, 0x36, 0x34, 0x35]:
+                target = script.getIndexOfInstruction(cmd.parameters[0])
+                if target != None:
+                    blockStarts.add(target)
+                    predecessors[target].append(i)
+                blockStarts.add(i + 1)
+        # Going up from index 0, every index that can get to low and isn't
+        # known to get lower already has low as its lowest index
+        lowestIndex = [None] * (len(cmds) + 1)
+        for low in range(len(cmds) + 1):
+            if lowestIndex[low] != None:
+                continue
+            lowestIndex[low] = low
+            pending = [low]
+            while len(pending) > 0:
+                for j in predecessors[pending.pop()]:
+                    if lowestIndex[j] == None:
+                        lowestIndex[j] = low
+                        pending.append(j)
+        return blockStarts, lowestIndex
+
+    #script - mscScript object
+    #startIndex - index in the script to start at
+    #stack - the current stack, blank at start of script
+    #endPosition - when to stop searching (i.e. when the stack is empty and paths recombine)
+    #
+    #Walks the script keeping a stack of the commands that pushed each value.
+    #Both sides of an if/ifNot are followed: the side it jumps to is walked
+    #first as a nested walk (a frame) on the same stack, until the stack is
+    #empty past endPosition, then the walk continues after the branch. Frames
+    #are kept in a list rather than by recursing, and the stack left by each
+    #walk is remembered for every (block, endPosition, stack) state it went
+    #through, so arriving at a known state again skips straight to its
+    #result. Once a walk can't get back before its endPosition, which
+    #endPosition it has no longer matters and states are shared between
+    #such walks. Walks that arrive at a state they are still in the middle
+    #of would never finish and are cut short there.
+    def emuScript(self, script, startIndex, stack, passCount, endPosition=None, depth=0):
+        scriptName = self.scriptNames[script.bounds[0]]
+        cmds = script.cmds
+        blockStarts, lowestIndex = self.getBlocks(script)
+        effectCommands = [0x2f, 0x30, 0x31, 0x2c, 0x2d, 0x1C] if passCount == 0 else [0x1C, 0x41, 0x2f, 0x30, 0x31]
+        finishedStates = {}
+        runningStates = set()
+        # [next index, endPosition, states entered]
+        frames = [[startIndex, endPosition, []]]
+        while len(frames) > 0:
+            frame = frames[-1]
+            i, end, states = frame
+            child = None
+            while i < len(cmds):
+                if end != None and i >= end and len(stack) == 0:
+                    break
+                if i in blockStarts:
+                    # scriptCalledVars only matters after the first pass
+                    stateEnd = end
+                    if end != None and lowestIndex[i] >= end:
+                        stateEnd = -1
+                    state = (i, stateEnd, tuple(stack), self.calledVarsCount if passCount else 0)
+                    if state in finishedStates:
+                        stack[:] = finishedStates[state]
+                        break
+                    if state in runningStates:
+                        break
+                    runningStates.add(state)
+                    states.append(state)
+                cmd = cmds[i]
+                #Get the number of pops based on the command and it's parameters
+                popCount = COMMAND_STACKPOPS[cmd.command](cmd.parameters)
+                popped = []
+                for _ in range(popCount):
+                    if len(stack) == 0:
+                        break
+                    #Pop the needed commands into the popped list in case one of them is needed
+                    popped.append(stack.pop())
+
+                if cmd.command in effectCommands:
+                    self.emuCommand(cmd, popped, passCount, scriptName)
+
+                #if the command is push, just readd the command before it
+                if cmd.command == 0x32:
+                    stack.append(cmds[i-1])
+                #if the pushBit is set, push the command onto the stack
+                if cmd.pushBit:
+                    stack.append(cmd)
+                #if the command is if or ifNot then walk the side it jumps to first
+                if cmd.command in [0x34, 0x35]:
+                    jumpIndex = script.getIndexOfInstruction(cmd.parameters[0])
+                    if cmds[jumpIndex - 1].command in [4, 5, 0x36]:
+                        endOfBlock = script.getIndexOfInstruction(cmds[jumpIndex - 1].parameters[0])
+                        child = [jumpIndex, endOfBlock, []]
+                    elif len(stack) > 0:
+                        child = [jumpIndex, jumpIndex, []]
+                    i += 1
+                    if child != None:
+                        break
+                #if it hits a jump or else command, just jump it
+                elif cmd.command in [4, 5, 0x36]:
+                    newIndex = script.getIndexOfInstruction(cmd.parameters[0])
+                    if newIndex == None:
+                        i += 1
+                    else:
+                        i = newIndex
+                else:
+                    #if it isn't a jump, move on to the next command
+                    i += 1
+            if child != None:
+                frame[0] = i
+                frames.append(child)
+                continue
+            # This walk is done, everything it went through ends the same way
+            result = tuple(stack)
+            for state in states:
+                finishedStates[state] = result
+                runningStates.discard(state)
+            frames.pop()
+        return True
+
+    def disasm(self, fname):
+        # Start from empty tables in case this disassembler is reused
+        self.scriptNames = {}
+        self.scriptOffsets = []
+        self.mscFile = MscFile()
+
+        with open(fname, 'rb') as f:
+            self.mscFile.readFromFile(f)
+
+        for i,script in enumerate(self.mscFile):
+            if not script.bounds[0] in self.scriptNames:
+                self.scriptNames[script.bounds[0]] = script.name
+                self.scriptOffsets.append(script.bounds[0])
+
+        self.scriptCalledVars = {}
+        self.calledVarsCount = 0
+        self.scriptCallers = {}
+
+        # First pass: direct script references, the local variables each
+        # script uses as one, and the call graph
+        for script in self.mscFile:
+            self.emuScript(script, 0, [], 0)
+
+        # Then pass scriptCalledVars on from callees to callers until
+        # nothing changes. A script is only walked again when its own
+        # variables or those of a script it calls got new entries.
+        scriptsByName = {}
+        for script in self.mscFile:
+            scriptsByName.setdefault(script.name, []).append(script)
+        queue = deque(self.mscFile)
+        queued = set(id(script) for script in queue)
+        while len(queue) > 0:
+            script = queue.popleft()
+            queued.discard(id(script))
+            name = self.scriptNames[script.bounds[0]]
+            calledVarCount = len(self.scriptCalledVars.get(name, []))
+            self.emuScript(script, 0, [], 1)
+            if len(self.scriptCalledVars.get(name, [])) != calledVarCount:
+                for caller in [name] + sorted(self.scriptCallers.get(name, [])):
+                    for callerScript in scriptsByName.get(caller, []):
+                        if not id(callerScript) in queued:
+                            queued.add(id(callerScript))
+                            queue.append(callerScript)
+
+        for i,script in enumerate(self.mscFile):
+            pickTypes(script)
+
+            jumpPositions = {}
+            for cmd in script:
+                if cmd.command in [0x4, 0x5, 0x2e, 0x34, 0x35, 0x36]:
+                    if not cmd.parameters[0] in jumpPositions:
+                        jumpPositions[cmd.parameters[0]] = Label("loc_%X" % (cmd.parameters[0]))
+                    cmd.parameters[0] = jumpPositions[cmd.parameters[0]]
+
+            # Merge the labels in ahead of the commands they point at in one
+            # pass rather than inserting them into the list one at a time
+            if len(jumpPositions) > 0:
+                cmds = []
+                for cmd in script.cmds:
+                    if cmd.commandPosition in jumpPositions:
+                        cmds.append(jumpPositions[cmd.commandPosition])
+                    cmds.append(cmd)
+                script.cmds[:] = cmds
+
+        return self.mscFile
+
 def disasm(fname):
-    global clearedPaths,scriptCalledVars,mscFile,charAcmdNames
-
-    mscFile = MscFile()
-
-    with open(fname, 'rb') as f:
-        mscFile.readFromFile(f)
-
-    for i,script in enumerate(mscFile):
-        if not script.bounds[0] in scriptOffsets:
-            scriptNames[script.bounds[0]] = script.name
-            scriptOffsets.append(script.bounds[0])
-
-    scriptCalledVars = {}
-
-    # 2 = number of passes for script offset analysis
-    for i in range(2):
-        for script in mscFile:
-            clearedPaths = []
-            emuScript(script, 0, [], i)
-
-    for i,script in enumerate(mscFile):
-        clearedPaths = []
-        emuScript(script, 0, [], 2)
-        pickTypes(script)
-
-        jumpPositions = {}
-        for cmd in script:
-            if cmd.command in [0x4, 0x5, 0x2e, 0x34, 0x35, 0x36]:
-                if not cmd.parameters[0] in jumpPositions:
-                    jumpPositions[cmd.parameters[0]] = Label("loc_%X" % (cmd.parameters[0]))
-                cmd.parameters[0] = jumpPositions[cmd.parameters[0]]
-
-        j = 0
-        while j < len(script):
-            cmd = script[j]
-            if cmd.commandPosition in jumpPositions:
-                script.cmds.insert(j, jumpPositions[cmd.commandPosition])
-                # Go ahead and skip over the label
-                j += 1
-            j += 1
-
-    return mscFile
\ No newline at end of file
+    return Disassembler().disasm(fname)
@@ -6,7 +6,9 @@
 from sys import version_info
 isPython3 = version_info >= (3,)
 assert isPython3 #If this fails switch to python 3
-import struct, tempfile
+import struct, mmap, io
+from array import array
+from bisect import bisect_right
 
 MSC_MAGIC = b'\xB2\xAC\xBC\xBA\xE6\x90\x32\x01\xFD\x02\x00\x00\x00\x00\x00\x00'
 
@@ -263,29 +265,189 @@ COMMAND_STACKPOPS = {
     0xFFFF : lambda params: 0
 }
 
+# Precompiled big endian parameter layout of each command
+COMMAND_STRUCTS = {}
+for k, v in COMMAND_FORMAT.items():
+    COMMAND_STRUCTS[k] = struct.Struct('>'+v)
+
+# Number of parameters each command takes
+COMMAND_PARAM_COUNTS = {}
+for k, v in COMMAND_FORMAT.items():
+    COMMAND_PARAM_COUNTS[k] = len(v)
+
+# Listing text between the position and the parameters of each command, for
+# a command without and with its pushBit set. Padded the way Command.__str__
+# pads it for the usual 8 digit positions.
+LISTING_PREFIXES = ({}, {})
+for k, v in COMMAND_NAMES.items():
+    for pushBit in [False, True]:
+        prefix = ':' + (' -> ' if pushBit else '    ') + ' ' + v + ' '
+        LISTING_PREFIXES[pushBit][k] = prefix + (37 - 8 - len(prefix)) * ' '
+
 TYPE_SIZES = {
     'B' : 1,
     'H' : 2,
     'I' : 4
 }
 
+# Values an assembler operand of each type can take, ints can also be
+# written as negative numbers
+TYPE_RANGES = {
+    'B' : (0, 0xff),
+    'H' : (0, 0xffff),
+    'I' : (-0x80000000, 0xffffffff)
+}
+
 def getSizeFromFormat(formatString):
     s = 0
     for char in formatString:
         s += TYPE_SIZES[char]
     return s
 
-def disassembleCommands(rawCommands, startOffset):
-    pos = 0
+# Disassembles rawCommands[start:end] (the whole buffer by default), the
+# buffer can be bytes, a memoryview or an mmap and is never sliced
+def disassembleCommands(rawCommands, startOffset, start=0, end=None):
+    if end == None or end > len(rawCommands):
+        end = len(rawCommands)
+    pos = start
     commands = []
-    while pos < len(rawCommands):
+    while pos < end:
         newCommand = Command()
         newCommand.read(rawCommands, pos)
-        newCommand.commandPosition = startOffset + pos
+        newCommand.commandPosition = startOffset + pos - start
         commands.append(newCommand)
         pos += (1 + newCommand.paramSize)
     return commands
 
+# Parameter struct of every 7 bit opcode, None for unknown ones
+OPCODE_STRUCTS = [COMMAND_STRUCTS.get(opcode) if opcode in COMMAND_NAMES else None for opcode in range(0x80)]
+
+# Encoded size of every 7 bit opcode, unknown ones are a single byte
+OPCODE_SIZES = [1 + (OPCODE_STRUCTS[opcode].size if OPCODE_STRUCTS[opcode] != None else 0) for opcode in range(0x80)]
+
+# The opcode byte followed by the parameters of every 7 bit opcode
+OPCODE_WRITE_STRUCTS = [struct.Struct('>B'+COMMAND_FORMAT[opcode]) if OPCODE_STRUCTS[opcode] != None else None for opcode in range(0x80)]
+
+# Commands whose first parameter is a position in the file
+JUMP_COMMANDS = [0x4, 0x5, 0x2e, 0x34, 0x35, 0x36]
+
+# pushInt and pushShort, the constants scripts call other scripts through
+PUSH_CONSTANT_COMMANDS = [0xA, 0xD]
+
+# New value of a pushed script address, see MscFile.write
+def relocateConstant(opcode, value, scriptStarts):
+    value = scriptStarts[value]
+    if opcode == 0xD and value > 0xFFFF:
+        raise ValueError("Script moved to 0x{:X}, which no longer fits in a pushShort".format(value))
+    return value
+
+# Struct-of-arrays storage for instructions, a few bytes per command instead
+# of a full Command object. A file keeps one of these for all of its scripts,
+# indexing it builds a Command on demand. Every command has at most two
+# parameters.
+class PackedCommands:
+    def __init__(self):
+        self.opcodes = bytearray()
+        self.pushBits = bytearray()
+        self.positions = array('I')
+        self.params0 = array('I')
+        self.params1 = array('I')
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def __getitem__(self, index):
+        opcode = self.opcodes[index]
+        cmd = Command()
+        if opcode in COMMAND_NAMES:
+            cmd.command = opcode
+            cmd.paramSize = COMMAND_STRUCTS[opcode].size
+            paramCount = COMMAND_PARAM_COUNTS[opcode]
+            if paramCount == 0:
+                cmd.parameters = []
+            elif paramCount == 1:
+                cmd.parameters = [self.params0[index]]
+            else:
+                cmd.parameters = [self.params0[index], self.params1[index]]
+        else:
+            cmd.command = 0xFFFE #unknown command, display as "byte X"
+            cmd.parameters = [opcode]
+        cmd.pushBit = self.pushBits[index] != 0
+        cmd.commandPosition = self.positions[index]
+        return cmd
+
+    def __iter__(self):
+        for i in range(len(self.opcodes)):
+            yield self[i]
+
+    # Disassembles rawCommands[start:end] the same way disassembleCommands does
+    # and appends the result
+    def read(self, rawCommands, startOffset, start=0, end=None):
+        if end == None or end > len(rawCommands):
+            end = len(rawCommands)
+        appendOpcode = self.opcodes.append
+        appendPushBit = self.pushBits.append
+        appendPosition = self.positions.append
+        appendParam0 = self.params0.append
+        appendParam1 = self.params1.append
+        positionBase = startOffset - start
+        pos = start
+        while pos < end:
+            byte = rawCommands[pos]
+            opcode = byte & 0x7F
+            appendOpcode(opcode)
+            appendPushBit(byte >> 7)
+            appendPosition(positionBase + pos)
+            paramStruct = OPCODE_STRUCTS[opcode]
+            if paramStruct != None:
+                params = paramStruct.unpack_from(rawCommands, pos+1) + (0, 0)
+                appendParam0(params[0])
+                appendParam1(params[1])
+                pos += 1 + paramStruct.size
+            elif opcode in COMMAND_NAMES:
+                # Named but without a parameter format (error_37)
+                raise KeyError(opcode)
+            else:
+                appendParam0(0)
+                appendParam1(0)
+                pos += 1
+        return self
+
+    def toCommands(self, first=0, last=None):
+        if last == None:
+            last = len(self.opcodes)
+        opcodes = self.opcodes
+        pushBits = self.pushBits
+        positions = self.positions
+        params0 = self.params0
+        params1 = self.params1
+        cmds = []
+        for i in range(first, last):
+            opcode = opcodes[i]
+            cmd = Command()
+            paramStruct = OPCODE_STRUCTS[opcode]
+            if paramStruct != None:
+                cmd.command = opcode
+                cmd.paramSize = paramStruct.size
+                paramCount = COMMAND_PARAM_COUNTS[opcode]
+                if paramCount == 1:
+                    cmd.parameters = [params0[i]]
+                elif paramCount == 2:
+                    cmd.parameters = [params0[i], params1[i]]
+                else:
+                    cmd.parameters = []
+            else:
+                cmd.command = 0xFFFE #unknown command, display as "byte X"
+                cmd.parameters = [opcode]
+            cmd.pushBit = pushBits[i] != 0
+            cmd.commandPosition = positions[i]
+            cmds.append(cmd)
+        return cmds
+
+    # Bytes used by the arrays themselves
+    def memoryUsage(self):
+        return (len(self.opcodes) + len(self.pushBits) + (len(self.positions) + len(self.params0) + len(self.params1)) * self.positions.itemsize)
+
 #Thanks Triptych https://stackoverflow.com/questions/1265665/python-check-if-a-string-represents-an-int-without-using-try-except
 def RepresentsInt(s):
     try:
@@ -301,7 +463,11 @@ def _RepresentsFloat(s):
     except:
         return False
 
-def parseCommands(text, refs={}, mscStrings=[]):
+def parseCommands(text, refs=None, mscStrings=None):
+    if refs == None:
+        refs = {}
+    if mscStrings == None:
+        mscStrings = []
     lines = text.replace(', ',',').split('\n')
     lines = [line.strip() for line in lines if line.strip() != '']
     lines = [line.split('#')[0] for line in lines if line.split('#')[0] != '']
@@ -345,13 +511,156 @@ def parseCommands(text, refs={}, mscStrings=[]):
                 cmd.parameters[i] = aliases[cmd.parameters[i]]
             elif cmd.parameters[i] in refs:
                 cmd.parameters[i] = refs[cmd.parameters[i]]
-            elif _RepresentsInt(cmd.parameters[i]):
+            elif RepresentsInt(cmd.parameters[i]):
                 cmd.parameters[i] = int(cmd.parameters[i], 0)
             elif _RepresentsFloat(cmd.parameters[i]):
                 cmd.parameters[i] = struct.unpack('>L', struct.pack('>f', float(cmd.parameters[i].rstrip('f'))))[0]
     return cmds
 
+# Everything the assembler needs about each command name, with and without
+# the trailing "." that sets the pushBit: (command, opcode byte or None for
+# raw data, struct of the whole encoded command, parameter types, offset of
+# each parameter in the encoded command)
+ASSEMBLER_COMMANDS = {}
+for k, v in COMMAND_IDS.items():
+    if not v in COMMAND_FORMAT:
+        continue
+    for pushBit in [False, True]:
+        rawData = v in [0xFFFE, 0xFFFF]
+        paramOffsets = []
+        offset = 0 if rawData else 1
+        for paramType in COMMAND_FORMAT[v]:
+            paramOffsets.append(offset)
+            offset += TYPE_SIZES[paramType]
+        ASSEMBLER_COMMANDS[k + ('.' if pushBit else '')] = (v, None if rawData else v | (0x80 if pushBit else 0),
+            COMMAND_STRUCTS[v] if rawData else OPCODE_WRITE_STRUCTS[v], COMMAND_FORMAT[v], paramOffsets)
+
+# Parses an int or float operand, floats become their 32 bit pattern.
+# Returns None for anything else.
+def _parseNumber(token):
+    try:
+        return int(token, 0)
+    except ValueError:
+        pass
+    try:
+        return struct.unpack('>L', struct.pack('>f', float(token.rstrip('f'))))[0]
+    except ValueError:
+        return None
+
+# Assembles the syntax parseCommands reads in a single pass over the source,
+# encoding each line straight into a bytearray. Names (labels, .alias names
+# and refs) get a zero placeholder and an entry in the fixup table which is
+# patched once the whole source was read, so they can be used before they
+# are defined. Label positions are relative to the start of the output.
+# Operands (names once resolved) that don't fit their field are an error.
+# Differences from parseCommands: string constants are kept as written
+# (spaces and ", " included, anything after the closing quote is ignored)
+# and "byte"/"long" only take the size of their data.
+class Assembler:
+    def __init__(self, refs=None, mscStrings=None):
+        self.refs = refs if refs != None else {}
+        self.strings = mscStrings if mscStrings != None else []
+        self.labels = {}
+        self.aliases = {}
+        # (position, parameter type, name, line number)
+        self.fixups = []
+        self.buffer = bytearray()
+
+    # source is a string or anything yielding lines such as an open file,
+    # returns the encoded commands
+    def assemble(self, source):
+        if isinstance(source, str):
+            source = io.StringIO(source)
+        for lineNumber, line in enumerate(source, 1):
+            self.assembleLine(line, lineNumber)
+        self.applyFixups()
+        return self.buffer
+
+    def assembleLine(self, line, lineNumber=0):
+        # A comment starts at the first '#' that isn't inside a string
+        commentStart = line.find('#')
+        quote = line.find('"')
+        if quote != -1 and quote < commentStart:
+            closingQuote = line.find('"', quote + 1)
+            commentStart = line.find('#', closingQuote + 1) if closingQuote != -1 else -1
+        if commentStart != -1:
+            line = line[:commentStart]
+        tokens = line.split(None, 1)
+        if len(tokens) == 0:
+            return
+        name = tokens[0]
+        operands = tokens[1] if len(tokens) > 1 else ''
+        if not name in ASSEMBLER_COMMANDS:
+            if name[-1] == ':':
+                self.labels[name[:-1]] = len(self.buffer)
+            elif name == '.alias':
+                value, alias = [operand.strip() for operand in operands.split(',')][:2]
+                self.aliases[alias] = int(value, 0)
+            else:
+                raise ValueError("Line {}: unknown command {}".format(lineNumber, name.rstrip('.')))
+            return
+
+        command, opcodeByte, commandStruct, paramTypes, paramOffsets = ASSEMBLER_COMMANDS[name]
+        if len(paramTypes) == 0:
+            self.buffer.append(opcodeByte)
+            return
+        if operands[:1] == '"' and command in [0xA, 0xD]:
+            operands = operands.rstrip()
+            end = operands.find('"', 1)
+            self.strings.append(operands[1:end] if end > 0 else operands[1:])
+            params = [len(self.strings) - 1]
+        else:
+            params = operands.split(',')
+            if len(params) < len(paramTypes) or params[0].strip() == '':
+                raise ValueError("Line {}: {} takes {} parameters".format(lineNumber, name.rstrip('.'), len(paramTypes)))
+
+        pos = len(self.buffer)
+        values = [] if opcodeByte == None else [opcodeByte]
+        for i in range(len(paramTypes)):
+            param = params[i]
+            if type(param) == int:
+                values.append(param)
+                continue
+            param = param.strip()
+            value = _parseNumber(param) if param[0] in '0123456789+-.' else None
+            if value == None:
+                self.fixups.append((pos + paramOffsets[i], paramTypes[i], param, lineNumber))
+                value = 0
+            else:
+                self.checkRange(value, paramTypes[i], param, lineNumber)
+            values.append(value & 0xffffffff)
+        if command == 0xFFFE and name[-1] == '.':
+            # A byte keeps the pushBit like MscFile.write does
+            values[0] = (values[0] & 0xff) | 0x80
+        self.buffer += commandStruct.pack(*values)
+
+    def resolve(self, name, lineNumber=0):
+        if name in self.labels:
+            return self.labels[name]
+        if name in self.aliases:
+            return self.aliases[name]
+        if name in self.refs:
+            return self.refs[name]
+        value = _parseNumber(name)
+        if value == None:
+            raise ValueError("Line {}: unknown name {}".format(lineNumber, name))
+        return value
+
+    def checkRange(self, value, paramType, param, lineNumber=0):
+        low, high = TYPE_RANGES[paramType]
+        if value < low or value > high:
+            raise ValueError("Line {}: {} is out of range for a {} byte operand".format(lineNumber, param, TYPE_SIZES[paramType]))
+
+    def applyFixups(self):
+        for pos, paramType, name, lineNumber in self.fixups:
+            value = self.resolve(name, lineNumber)
+            self.checkRange(value, paramType, name, lineNumber)
+            struct.pack_into('>' + paramType, self.buffer, pos, value & 0xffffffff)
+        self.fixups = []
+
 class Command:
+    __slots__ = ('command', 'parameters', 'pushBit', 'paramSize', 'commandPosition', 'debugString')
+
     def __init__(self, command=0, parameters=[], pushBit=False):
         self.command = command
         self.parameters = parameters
@@ -364,11 +673,13 @@ class Command:
         return getSizeFromFormat(COMMAND_FORMAT[self.command]) + 1
 
     def read(self, byteBuffer, pos):
-        self.command = int(byteBuffer[pos]) & 0x7F
-        self.pushBit = (int(byteBuffer[pos]) & 0x80) != 0
+        byte = int(byteBuffer[pos])
+        self.command = byte & 0x7F
+        self.pushBit = (byte & 0x80) != 0
         if self.command in COMMAND_NAMES:
-            self.paramSize = getSizeFromFormat(COMMAND_FORMAT[self.command])
-            self.parameters = list(struct.unpack('>'+COMMAND_FORMAT[self.command], byteBuffer[pos+1:pos+1+self.paramSize]))
+            paramStruct = COMMAND_STRUCTS[self.command]
+            self.paramSize = paramStruct.size
+            self.parameters = list(paramStruct.unpack_from(byteBuffer, pos+1))
         else:
             self.parameters = [self.command]
             self.command = 0xFFFE #unknown command, display as "byte X"
@@ -406,13 +717,108 @@ class Command:
             return com+self.strParams()+'   #'+self.debugString
         return com+self.strParams()
 
+# The string table of a lazily read file, each entry is only decoded the
+# first time it is indexed
+class LazyStrings:
+    def __init__(self, view, offset, stringSize, stringCount):
+        self.view = view
+        self.offset = offset
+        self.stringSize = stringSize
+        self.decoded = [None] * stringCount
+
+    def __len__(self):
+        return len(self.decoded)
+
+    def __getitem__(self, key):
+        if type(key) == slice:
+            return [self[i] for i in range(*key.indices(len(self.decoded)))]
+        string = self.decoded[key]
+        if string == None:
+            if key < 0:
+                key += len(self.decoded)
+            start = self.offset + key * self.stringSize
+            string = str(self.view[start:start + self.stringSize], 'utf-8').replace('\x00','')
+            self.decoded[key] = string
+        return string
+
+    def __setitem__(self, key, value):
+        self.decoded[key] = value
+
+    def __iter__(self):
+        for i in range(len(self.decoded)):
+            yield self[i]
+
+    def append(self, string):
+        self.decoded.append(string)
+
+    def index(self, string):
+        return self[:].index(string)
+
+    # A plain list of every string, pickling does the same since the
+    # file buffer can't go along
+    def toList(self):
+        return self[:]
+
+    def __reduce__(self):
+        return (list, (self.toList(),))
+
+# Scripts read packed only keep their range of the file's PackedCommands
+# (or for lazy reads, just their source) until their cmds are first used.
+# The list is then built once by buildCommands and stored on the script,
+# where it shadows this descriptor.
+class LazyCommands:
+    def __get__(self, script, owner=None):
+        if script == None:
+            return self
+        return script.buildCommands()
+
 class MscScript:
+    cmds = LazyCommands()
+
     def __init__(self):
-        self.cmds = []
+        self.packed = None
+        self.packedRange = (0, 0)
+        self.source = None
+        self.positionIndex = None
+        self.positionIndexOf = None
+        self.positionIndexLength = 0
         self.name = 'Unnamed Script'
         self.bounds = [0,0]
         self._iterationPosition = 0
 
+    # Disassembles a lazily read script into its own PackedCommands
+    def unpack(self):
+        buf, start, end = self.source
+        self.source = None
+        self.readFromBuffer(buf, start, end)
+
+    # Builds the Command list of a script that is still packed (or not
+    # disassembled yet) and returns it. The packed form is dropped since the
+    # list is what gets modified from then on.
+    def buildCommands(self):
+        if 'cmds' in self.__dict__:
+            return self.cmds
+        if self.source != None:
+            self.unpack()
+        if self.packed == None:
+            cmds = []
+        else:
+            cmds = self.packed.toCommands(*self.packedRange)
+        self.cmds = cmds
+        self.packed = None
+        self.packedRange = (0, 0)
+        return cmds
+
+    # Don't drag the whole file's PackedCommands along when pickled
+    def __getstate__(self):
+        self.buildCommands()
+        state = self.__dict__.copy()
+        state['packed'] = None
+        state['source'] = None
+        state['positionIndex'] = None
+        state['positionIndexOf'] = None
+        return state
+
     def __getitem__(self, key):
         return self.cmds[key]
 
@@ -431,34 +837,188 @@ class MscScript:
         return self.__next__()
 
     def __str__(self):
-        returnVal = ""
-        for command in self.cmds:
-            returnVal += str(command) + "\n"
-        return returnVal
+        return "".join([line + "\n" for line in self.listingLines()])
+
+    # Listing line of every command, the same text str(command) gives. Scripts
+    # whose commands haven't been built yet are listed straight from the
+    # packed arrays.
+    def listingLines(self):
+        packed = self.packedCommands()
+        if packed == None:
+            return [str(command) for command in self.cmds]
+        opcodes = packed.opcodes
+        pushBits = packed.pushBits
+        positions = packed.positions
+        params0 = packed.params0
+        params1 = packed.params1
+        prefixes = LISTING_PREFIXES
+        lines = []
+        for i in range(*self.packedRange):
+            opcode = opcodes[i]
+            prefix = prefixes[pushBits[i] != 0]
+            if OPCODE_STRUCTS[opcode] != None:
+                paramCount = COMMAND_PARAM_COUNTS[opcode]
+                if paramCount == 0:
+                    lines.append("%08X" % positions[i] + prefix[opcode])
+                elif paramCount == 1:
+                    lines.append("%08X" % positions[i] + prefix[opcode] + hex(params0[i]))
+                else:
+                    lines.append("%08X" % positions[i] + prefix[opcode] + hex(params0[i]) + ", " + hex(params1[i]))
+            else:
+                # Unknown command, listed as "byte X"
+                lines.append("%08X" % positions[i] + prefix[0xFFFE] + hex(opcode))
+        return lines
 
     def __len__(self):
         return len(self.cmds)
 
+    # The PackedCommands holding the commands of this script, None once its
+    # Command objects were built (or when it has no commands)
+    def packedCommands(self):
+        if 'cmds' in self.__dict__:
+            return None
+        if self.source != None:
+            self.unpack()
+        return self.packed
+
+    # Encodes the script into buf at pos, returns the position after it.
+    # relocate maps the old target of each jump to its new one, it is None
+    # when nothing moved. scriptStarts maps the old start of every script
+    # that moved, and the name of every script, to its new start: pushed
+    # constants equal to one of them are written as the new start. Unknown
+    # opcodes ("byte X") keep their pushBit.
+    def writeInto(self, buf, pos, relocate=None, scriptStarts=None):
+        packed = self.packedCommands()
+        if packed != None:
+            opcodes = packed.opcodes
+            pushBits = packed.pushBits
+            params0 = packed.params0
+            params1 = packed.params1
+            for i in range(*self.packedRange):
+                opcode = opcodes[i]
+                commandStruct = OPCODE_WRITE_STRUCTS[opcode]
+                paramCount = COMMAND_PARAM_COUNTS[opcode] if commandStruct != None else 0
+                if paramCount == 0:
+                    buf[pos] = opcode | (pushBits[i] << 7)
+                    pos += OPCODE_SIZES[opcode]
+                    continue
+                if paramCount == 1:
+                    param = params0[i]
+                    if relocate != None and opcode in JUMP_COMMANDS:
+                        param = relocate(param) & 0xffffffff
+                    elif scriptStarts and opcode in PUSH_CONSTANT_COMMANDS and param in scriptStarts:
+                        param = relocateConstant(opcode, param, scriptStarts)
+                    commandStruct.pack_into(buf, pos, opcode | (pushBits[i] << 7), param)
+                else:
+                    commandStruct.pack_into(buf, pos, opcode | (pushBits[i] << 7), params0[i], params1[i])
+                pos += commandStruct.size
+            return pos
+
+        for cmd in self.cmds:
+            if type(cmd) != Command:
+                continue
+            c = cmd.command
+            params = cmd.parameters
+            if c in [0xFFFE, 0xFFFF]:
+                # Raw data, a byte keeps its pushBit
+                if c == 0xFFFE:
+                    buf[pos] = (params[0] & 0xff) | (0x80 if cmd.pushBit else 0)
+                else:
+                    COMMAND_STRUCTS[c].pack_into(buf, pos, params[0] & 0xffffffff)
+                pos += COMMAND_STRUCTS[c].size
+                continue
+            commandStruct = OPCODE_WRITE_STRUCTS[c]
+            paramCount = COMMAND_PARAM_COUNTS[c]
+            if paramCount == 0:
+                buf[pos] = c | (0x80 if cmd.pushBit else 0)
+            elif paramCount == 1:
+                param = params[0]
+                if relocate != None and c in JUMP_COMMANDS:
+                    param = relocate(param)
+                elif scriptStarts and c in PUSH_CONSTANT_COMMANDS and param in scriptStarts:
+                    param = relocateConstant(c, param, scriptStarts)
+                commandStruct.pack_into(buf, pos, c | (0x80 if cmd.pushBit else 0), param & 0xffffffff)
+            else:
+                commandStruct.pack_into(buf, pos, c | (0x80 if cmd.pushBit else 0), params[0] & 0xffffffff, params[1] & 0xffffffff)
+            pos += commandStruct.size
+        return pos
+
     def read(self, f, start, end):
         self.bounds = [start - 0x30, end - 0x30]
         f.seek(start)
         self.cmds = disassembleCommands(f.read(end - start), start - 0x30)
+        self.packed = None
+        self.source = None
+
+    # Disassembles buf[start:end] straight into Command objects
+    def readCommands(self, buf, start, end):
+        self.bounds = [start - 0x30, end - 0x30]
+        self.cmds = disassembleCommands(buf, start - 0x30, start, end)
+        self.packed = None
+        self.packedRange = (0, 0)
+        self.source = None
+
+    # Disassembles buf[start:end] into packed (a new PackedCommands by
+    # default), Command objects are only built when cmds is first used
+    def readFromBuffer(self, buf, start, end, packed=None):
+        if packed == None:
+            packed = PackedCommands()
+        self.bounds = [start - 0x30, end - 0x30]
+        try:
+            del self.cmds
+        except AttributeError:
+            pass
+        first = len(packed)
+        self.packed = packed.read(buf, start - 0x30, start, end)
+        self.packedRange = (first, len(packed))
+
+    # Only records where the script is, it gets disassembled the first time
+    # its instructions are used
+    def readLazily(self, buf, start, end):
+        self.bounds = [start - 0x30, end - 0x30]
+        try:
+            del self.cmds
+        except AttributeError:
+            pass
+        self.packed = None
+        self.source = (buf, start, end)
 
     def getInstructionText(self, index):
         if index < 0 or index >= len(self.cmds):
             return ""
         else:
-            return str(cmds[index])
+            return str(self.cmds[index])
+
+    # Maps the position of each command to its first index in cmds, labels
+    # and anything else without a position are skipped
+    def buildPositionIndex(self):
+        cmds = self.cmds
+        positionIndex = {}
+        for i, cmd in enumerate(cmds):
+            if isinstance(cmd, Command) and not cmd.commandPosition in positionIndex:
+                positionIndex[cmd.commandPosition] = i
+        self.positionIndex = positionIndex
+        self.positionIndexOf = cmds
+        self.positionIndexLength = len(cmds)
 
+    # Looks location up in the position index, None when no command of the
+    # script is there (e.g. a jump out of it). The index is rebuilt when cmds
+    # was replaced, changed length (label insertion) or was moved by
+    # setStart, and once more on a stale hit in case commands were edited in
+    # place. A miss is trusted otherwise, call buildPositionIndex after
+    # moving commands in place.
     def getIndexOfInstruction(self, location):
-        for i in range(len(self.cmds)):
-            cmd = self.cmds[i]
-            if cmd.commandPosition == location:
-                return i
-        return None
+        cmds = self.cmds
+        if self.positionIndexOf is not cmds or self.positionIndexLength != len(cmds):
+            self.buildPositionIndex()
+        i = self.positionIndex.get(location)
+        if i == None or getattr(cmds[i], 'commandPosition', None) == location:
+            return i
+        self.buildPositionIndex()
+        return self.positionIndex.get(location)
 
     def getInstructionOfIndex(self, index):
-        return cmd[index].commandPosition
+        return self.cmds[index].commandPosition
 
     def getCommand(self, location):
         cmdIndex = self.getIndexOfInstruction(location)
@@ -468,17 +1028,22 @@ class MscScript:
 
     def offset(self, offset):
         for cmd in self.cmds:
-            if cmd.command in [0x4, 0x5, 0x2e, 0x34, 0x35, 0x36]:
+            if cmd.command in JUMP_COMMANDS:
                 cmd.parameters[0] += offset
 
     def setStart(self, start):
         self.bounds[0] = start
+        self.positionIndexOf = None
         i = start
         for cmd in self.cmds:
             cmd.commandPosition = i
             i += len(cmd)
 
     def size(self):
+        packed = self.packedCommands()
+        if packed != None:
+            opcodeSizes = OPCODE_SIZES
+            return sum([opcodeSizes[opcode] for opcode in packed.opcodes[self.packedRange[0]:self.packedRange[1]]])
         s = 0
         for cmd in self.cmds:
             if type(cmd) == Command:
@@ -502,6 +1067,12 @@ class MscFile:
         self.stringSize = 0
         self.unk = 0
         self._iterationPosition = 0
+        self._buffer = None
+        self._view = None
+        self.scriptStarts = []
+        self.scriptStartNumbers = []
+        self.scriptNumbers = {}
+        self.scriptIndexLength = -1
 
     def __getitem__(self, key):
         return self.scripts[key]
@@ -521,60 +1092,227 @@ class MscFile:
         return self.__next__()
 
     def __str__(self):
-        returnVal = ""
+        f = io.StringIO()
+        self.writeListing(f)
+        return f.getvalue()
+
+    # Writes the same text as str(self) to the file f one script at a time,
+    # returns the number of commands listed
+    def writeListing(self, f):
+        lineCount = 0
         for script in self.scripts:
-            returnVal += (' ' * 20) + script.name + '\n' + ('-' * 50) + '\n'
-            for command in script:
-                returnVal += str(command) + "\n"
-        return returnVal
+            f.write((' ' * 20) + script.name + '\n' + ('-' * 50) + '\n')
+            lines = script.listingLines()
+            if len(lines) != 0:
+                f.write('\n'.join(lines))
+                f.write('\n')
+            lineCount += len(lines)
+        return lineCount
 
     def __len__(self):
         return len(self.scripts)
 
-    def readFromFile(self, f, headerEndianess = '<'):
-        f.seek(0x10)
-        entriesOffset = readInt(f, headerEndianess) + 0x30
+    # Serializes the file into one preallocated bytearray, the header and
+    # entry table in headerEndianess and the commands big endian like
+    # readFromBuffer expects. Scripts are laid out back to back in list order
+    # and the jumps and entry point are relocated along with the script they
+    # point into, the scripts themselves are left untouched. Script addresses
+    # pushed as constants are relocated too: any pushInt/pushShort of the old
+    # start of a script that moved (the same guess disasmlib makes), and any
+    # constant naming a script (disasmlib's ScriptRef). Strings longer than
+    # stringSize grow it to the next multiple of 0x10.
+    def write(self, headerEndianess='<'):
+        sizes = [script.size() for script in self.scripts]
+        starts = []
+        scriptsSize = 0
+        for size in sizes:
+            starts.append(scriptsSize)
+            scriptsSize += size
+
+        # Old start -> distance moved of every non-empty script, jumps are
+        # moved by the distance of the script containing their target
+        oldStarts = []
+        moved = []
+        scriptStarts = {}
+        for script, start, size in sorted(zip(self.scripts, starts, sizes), key=lambda s: s[0].bounds[0]):
+            if size != 0:
+                oldStarts.append(script.bounds[0])
+                moved.append(start - script.bounds[0])
+                if start != script.bounds[0]:
+                    scriptStarts.setdefault(script.bounds[0], start)
+        for script, start in zip(self.scripts, starts):
+            scriptStarts.setdefault(script.name, start)
+        relocate = None
+        if any(distance != 0 for distance in moved):
+            def relocate(position):
+                i = bisect_right(oldStarts, position) - 1
+                return position + moved[i] if i >= 0 else position
+
+        strings = [string.encode('utf-8') for string in self.strings]
+        stringSize = self.stringSize
+        longest = max([len(string) for string in strings] + [0])
+        if longest > stringSize:
+            stringSize = longest + (-longest) % 0x10
+
+        entriesOffset = 0x30 + scriptsSize
+        entriesOffset += (-entriesOffset) % 0x10
+        stringsOffset = entriesOffset + len(self.scripts) * 4
+        stringsOffset += (-stringsOffset) % 0x10
+        buf = bytearray(stringsOffset + len(strings) * stringSize)
+
+        buf[0:len(MSC_MAGIC)] = MSC_MAGIC
+        entryPoint = relocate(self.entryPoint) if relocate != None else self.entryPoint
+        struct.pack_into(headerEndianess+'6L', buf, 0x10, scriptsSize, entryPoint, len(self.scripts), self.unk, stringSize, len(strings))
+        pos = 0x30
+        for script in self.scripts:
+            pos = script.writeInto(buf, pos, relocate, scriptStarts)
+        struct.pack_into(headerEndianess+'%dL' % len(starts), buf, entriesOffset, *starts)
+        for i, string in enumerate(strings):
+            start = stringsOffset + i * stringSize
+            buf[start:start + len(string)] = string
+        return buf
+
+    def writeToFile(self, f, headerEndianess='<'):
+        f.write(self.write(headerEndianess))
+
+    # Reads the file through an mmap when possible so nothing but the decoded
+    # objects is ever copied, falls back to reading it all for file objects
+    # without a real file descriptor. With lazy=True the mapping stays open
+    # until close() and scripts and strings are decoded as they are used.
+    # With packed=True scripts are kept in PackedCommands until their cmds
+    # are used, which saves memory for callers that only read them (like the
+    # listing) but costs time for callers that use every script's cmds.
+    def readFromFile(self, f, headerEndianess = '<', lazy=False, packed=False):
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # No fileno (e.g. BytesIO) or an empty file, which mmap refuses
+            f.seek(0)
+            return self.readFromBuffer(f.read(), headerEndianess, lazy, packed)
+        if lazy:
+            return self.readFromBuffer(buf, headerEndianess, lazy, packed)
+        try:
+            return self.readFromBuffer(buf, headerEndianess, packed=packed)
+        finally:
+            buf.close()
+
+    def readFromBytes(self, b, headerEndianess='>', lazy=False, packed=False):
+        return self.readFromBuffer(b, headerEndianess, lazy, packed)
+
+    # Decodes the whole file from any buffer (bytes, bytearray, memoryview or
+    # mmap). Fields, offset tables and script bodies are decoded in place
+    # without slicing the buffer. With lazy=True only the header and the
+    # script bounds are read, the buffer is kept until close().
+    def readFromBuffer(self, buf, headerEndianess='<', lazy=False, packed=False):
+        if lazy:
+            self._buffer = buf
+            self._view = memoryview(buf)
+            self._readFromView(self._view, headerEndianess, lazy)
+            return self
+        with memoryview(buf) as view:
+            self._readFromView(view, headerEndianess, packed=packed)
+        return self
+
+    # Lets go of the buffer of a lazily read file, scripts and strings that
+    # weren't used before this can't be decoded anymore
+    def close(self):
+        if self._view == None:
+            return
+        self._view.release()
+        self._view = None
+        if type(self._buffer) == mmap.mmap:
+            self._buffer.close()
+        self._buffer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_buffer'] = None
+        state['_view'] = None
+        if type(self.strings) == LazyStrings:
+            state['strings'] = self.strings.toList()
+        return state
+
+    def _readFromView(self, view, headerEndianess, lazy=False, packed=False):
+        entriesOffset, self.entryPoint, entryCount, self.unk, self.stringSize, stringCount = struct.unpack_from(headerEndianess+'6L', view, 0x10)
+        entriesOffset += 0x30
         endOfScripts = entriesOffset
         if entriesOffset % 0x10 != 0:
             entriesOffset += 0x10 - (entriesOffset % 0x10)
-        self.entryPoint = readInt(f, headerEndianess)
-        entryCount = readInt(f, headerEndianess)
-        self.unk = readInt(f, headerEndianess)
-        self.stringSize = readInt(f, headerEndianess)
-        stringCount = readInt(f, headerEndianess)
-        scriptOffsets = []
-        f.seek(entriesOffset)
-        for i in range(entryCount):
-            scriptOffsets.append(readInt(f, headerEndianess) + 0x30)
-        sortedScriptOffsets = scriptOffsets
-        sortedScriptOffsets.sort()
-        if f.tell() % 0x10 != 0:
-            f.seek(0x10 - (f.tell() % 0x10), 1)
-        for i in range(stringCount):
-            self.strings.append(f.read(self.stringSize).decode('utf-8').replace('\x00',''))
+        # Script start offsets, sorted since the end of each script is the
+        # start of the next one in the file
+        scriptOffsets = sorted(offset + 0x30 for offset in struct.unpack_from(headerEndianess+'%dL' % entryCount, view, entriesOffset))
+        stringsOffset = entriesOffset + entryCount * 4
+        if stringsOffset % 0x10 != 0:
+            stringsOffset += 0x10 - (stringsOffset % 0x10)
+        stringsEnd = stringsOffset + stringCount * self.stringSize
+        if lazy:
+            self.strings = LazyStrings(view, stringsOffset, self.stringSize, stringCount)
+        elif self.stringSize > 0 and stringsEnd <= len(view):
+            for (string,) in struct.iter_unpack('%ds' % self.stringSize, view[stringsOffset:stringsEnd]):
+                self.strings.append(string.decode('utf-8').replace('\x00',''))
+        else:
+            # Truncated (or empty) string table, decode what is there
+            for i in range(stringCount):
+                start = stringsOffset + i * self.stringSize
+                self.strings.append(str(view[start:start + self.stringSize], 'utf-8').replace('\x00',''))
+        # Scripts are numbered by their position in the file, duplicate
+        # entries all map to the first script at that offset
+        scriptNumbers = {}
+        for i, offset in enumerate(scriptOffsets):
+            scriptNumbers.setdefault(offset, i)
+        packedCommands = PackedCommands() if packed else None
         for j in scriptOffsets:
-            i = sortedScriptOffsets.index(j)
-            start = sortedScriptOffsets[i]
+            i = scriptNumbers[j]
+            start = scriptOffsets[i]
             if i != len(scriptOffsets) - 1:
-                end = sortedScriptOffsets[i+1]
+                end = scriptOffsets[i+1]
             else:
                 end = endOfScripts
             newScript = MscScript()
             newScript.name = 'func_%i' % i
-            newScript.read(f, start, end)
+            if lazy:
+                newScript.readLazily(view, start, end)
+            elif packed:
+                newScript.readFromBuffer(view, start, end, packedCommands)
+            else:
+                newScript.readCommands(view, start, end)
             self.scripts.append(newScript)
-        return self
+        self.buildScriptIndex()
 
-    def readFromBytes(self, b, headerEndianess='>'):
-        with tempfile.SpooledTemporaryFile(mode='w+b') as f:
-            f.write(b)
-            f.seek(0)
-            self.readFromFile(f, headerEndianess)
+    # Maps the start address of each non-empty script to the number of the
+    # first script starting there, with the starts sorted to bisect other
+    # addresses into. Call again after moving scripts around.
+    def buildScriptIndex(self):
+        self.scriptNumbers = {}
+        for i, script in enumerate(self.scripts):
+            if script.bounds[0] < script.bounds[1]:
+                self.scriptNumbers.setdefault(script.bounds[0], i)
+        self.scriptStarts = sorted(self.scriptNumbers)
+        self.scriptStartNumbers = [self.scriptNumbers[start] for start in self.scriptStarts]
+        self.scriptIndexLength = len(self.scripts)
+
+    # Number of the script containing location, or None. The index is
+    # rebuilt when scripts were added or removed, or when the script found
+    # doesn't start where the index says anymore.
+    def getScriptNumberAtLocation(self, location):
+        if self.scriptIndexLength != len(self.scripts):
+            self.buildScriptIndex()
+        pos = bisect_right(self.scriptStarts, location) - 1
+        if pos < 0:
+            return None
+        i = self.scriptStartNumbers[pos]
+        bounds = self.scripts[i].bounds
+        if bounds[0] != self.scriptStarts[pos]:
+            self.buildScriptIndex()
+            return self.getScriptNumberAtLocation(location)
+        if bounds[1] > location:
+            return i
+        return None
 
     def getScriptAtLocation(self, location):
-        for script in self.scripts:
-            if script.bounds[0] <= location and script.bounds[1] > location:
-                return script
+        i = self.getScriptNumberAtLocation(location)
+        if i != None:
+            return self.scripts[i]
 
     def addDebugStrings(self):
         for script in self.scripts:
@@ -596,8 +1334,7 @@ class MscFile:
                         if script[j].pushBit:
                             print(str(j)+' has pushBit')
                             if script[j].command in (0xa, 0xd):
-                                thisScript = self.getScriptAtLocation(script[j].parameters[0])
-                                scriptNum = self.scripts.index(thisScript)
+                                scriptNum = self.getScriptNumberAtLocation(script[j].parameters[0])
                                 print("func_"+str(scriptNum))
                                 command.parameters.insert(0, "func_"+str(scriptNum))
                             break
@@ -1,10 +1,20 @@
+import sys
+import mscdec_client
+# --client only forwards the command line to a running --serve process, so
+# it is dispatched before the imports the decompiler itself needs
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] == '--client':
+    sys.exit(mscdec_client.main(sys.argv[2:]))
+
 from msc import *
-from xml_info import MscXmlInfo, VariableLabel, getXmlInfoPath
+from xml_info import MscXmlInfo, VariableLabel, getXmlInfoPath, getXmlCache
+from result_cache import ResultCache, DEFAULT_RESULT_CACHE_SIZE
 from argparse import ArgumentParser
 import ast2str as c_ast
 from disasmlib import disasm as mscsb_disasm
 from disasmlib import Label, ScriptRef
-import operator, os, timeit
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout, redirect_stderr
+import operator, os, glob, timeit, io, socket, traceback
 import math
 
 class DecompilerError(Exception):
@@ -96,114 +106,82 @@ ASSIGNMENT_OPERATIONS = {
     0x45 : "/="
 }
 
+# Collects the int/float evidence for every variable a function references
+# in a single pass over its commands, returns a dict of
+# (scope, varNum) -> [intCount, floatCount]. A pushed variable counts for the
+# command that pops it off the stack unless a cast comes first.
+def getVarEvidence(func):
+    evidence = {}
+    # Values below the oldest pending variable never matter, so the stack
+    # only holds that variable and whatever gets pushed on top of it
+    stack = []
+    for cmd in func:
+        if type(cmd) != Command:
+            continue
+        c = cmd.command
+        if len(stack) != 0:
+            if c in [0x38, 0x39]:
+                # Anything pushed before a cast is left without evidence
+                stack = []
+            else:
+                popCount = COMMAND_STACKPOPS[c](cmd.parameters)
+                # push (0x32) has a negative pop count for the value it copies
+                for _ in range(-popCount):
+                    stack.append(None)
+                for _ in range(min(popCount, len(stack))):
+                    counts = stack.pop()
+                    if counts != None:
+                        if c in USES_FLOAT:
+                            counts[1] += 1
+                        elif c in USES_INT:
+                            counts[0] += 1
+        if c in VAR_COMMANDS and cmd.parameters[0] in [0, 1]:
+            key = (cmd.parameters[0], cmd.parameters[1])
+            if not key in evidence:
+                evidence[key] = [0, 0]
+            if c in INT_VAR_COMMANDS:
+                evidence[key][0] += 1
+            elif c in FLOAT_VAR_COMMANDS:
+                evidence[key][1] += 1
+            else:
+                stack.append(evidence[key])
+                continue
+        if cmd.pushBit and len(stack) != 0:
+            stack.append(None)
+    return evidence
+
 # Detect all the global vars referenced in the file (and any that must exist) and return them
+# takes the getVarEvidence result of every function
 # returns a list of c_ast.Decl objects (type and name)
-def getGlobalVars(mscFile):
-    varInt = {}
-    varFloat = {}
+def getGlobalVars(allVarEvidence):
+    varCounts = {}
     globalVarCount = 0
-    for func in mscFile:
-        for i,cmd in enumerate(func):
-            if type(cmd) != Command:
+    for evidence in allVarEvidence:
+        for (scope, varNum), counts in evidence.items():
+            if scope != 1:
                 continue
-            if cmd.command in VAR_COMMANDS and cmd.parameters[0] == 1:
-                varNum = cmd.parameters[1]
-                if varNum > globalVarCount:
-                    globalVarCount = varNum
-                if cmd.command in INT_VAR_COMMANDS:
-                    if not varNum in varInt:
-                        varInt[varNum] = 1
-                    else:
-                        varInt[varNum] += 1
-                elif cmd.command in FLOAT_VAR_COMMANDS:
-                    if not varNum in varFloat:
-                        varFloat[varNum] = 1
-                    else:
-                        varFloat[varNum] += 1
-                elif cmd.command == 0xb:
-                    i += 1
-                    stackSize = 1
-                    while i < len(func):
-                        if type(func[i]) == Command:
-                            if func[i].command in [0x38, 0x39]:
-                                break
-                            stackSize -= COMMAND_STACKPOPS[func[i].command](func[i].parameters)
-                            if stackSize <= 0:
-                                if func[i].command in USES_FLOAT:
-                                    if not varNum in varFloat:
-                                        varFloat[varNum] = 1
-                                    else:
-                                        varFloat[varNum] += 1
-                                elif func[i].command in USES_INT:
-                                    if not varNum in varInt:
-                                        varInt[varNum] = 1
-                                    else:
-                                        varInt[varNum] += 1
-                                break
-                            stackSize += 1 if func[i].pushBit else 0
-                        i += 1
+            if varNum > globalVarCount:
+                globalVarCount = varNum
+            if not varNum in varCounts:
+                varCounts[varNum] = [0, 0]
+            varCounts[varNum][0] += counts[0]
+            varCounts[varNum][1] += counts[1]
 
     globalVarTypes = ["int" for i in range(globalVarCount + 1)]
     for i in range(globalVarCount + 1):
-        if i in varInt or i in varFloat:
-            intCount = varInt[i] if i in varInt else 0
-            floatCount = varFloat[i] if i in varFloat else 0
-            if floatCount > intCount:
-                globalVarTypes[i] = "float"
+        if i in varCounts and varCounts[i][1] > varCounts[i][0]:
+            globalVarTypes[i] = "float"
 
     return [c_ast.Decl(globalVarTypes[i], "global{}".format(i)) for i in range(globalVarCount + 1)]
 
-# Gets the local variable types for a function
+# Gets the local variable types for a function from its getVarEvidence result
 # is merely an educated guess based on what commands
 # reference it.
-def getLocalVarTypes(func, varCount):
-    varInt = {}
-    varFloat = {}
-    for i,cmd in enumerate(func):
-        if type(cmd) != Command:
-            continue
-        if cmd.command in VAR_COMMANDS and cmd.parameters[0] == 0:
-            varNum = cmd.parameters[1]
-            if cmd.command in INT_VAR_COMMANDS:
-                if not varNum in varInt:
-                    varInt[varNum] = 1
-                else:
-                    varInt[varNum] += 1
-            elif cmd.command in FLOAT_VAR_COMMANDS:
-                if not varNum in varFloat:
-                    varFloat[varNum] = 1
-                else:
-                    varFloat[varNum] += 1
-            elif cmd.command == 0xb:
-                i += 1
-                stackSize = 1
-                while i < len(func):
-                    if type(func[i]) == Command:
-                        if func[i].command in [0x38, 0x39]:
-                            break
-                        stackSize -= COMMAND_STACKPOPS[func[i].command](func[i].parameters)
-                        if stackSize <= 0:
-                            if func[i].command in USES_FLOAT:
-                                if not varNum in varFloat:
-                                    varFloat[varNum] = 1
-                                else:
-                                    varFloat[varNum] += 1
-                            elif func[i].command in USES_INT:
-                                if not varNum in varInt:
-                                    varInt[varNum] = 1
-                                else:
-                                    varInt[varNum] += 1
-                            break
-                        stackSize += 1 if func[i].pushBit else 0
-                    i += 1
-
+def getLocalVarTypes(evidence, varCount):
     localVarTypes = ["int" for i in range(varCount)]
     for i in range(varCount):
-        if i in varInt or i in varFloat:
-            intCount = varInt[i] if i in varInt else 0
-            floatCount = varFloat[i] if i in varFloat else 0
-            if floatCount > intCount:
-                localVarTypes[i] = "float"
+        if (0, i) in evidence and evidence[(0, i)][1] > evidence[(0, i)][0]:
+            localVarTypes[i] = "float"
 
     return localVarTypes
 
@@ -285,31 +263,6 @@ def ifToTernaryOp(ifStatement):
                 return c_ast.BinaryOp("&&", a, b)
     return ternaryTemp
 
-# Helper function for decompileCmd which is used for recursive calls in order
-# to grab arguments based on their pushbit so they can be used within the
-# original command. Returns a tuple of lists, the first being commands run in between
-# and the later being the arguments to use.
-def getArgs(argc):
-    global currentFunc, index
-    other = []
-    args = []
-    while len(args) < argc and index >= 0:
-        index -= 1
-        thisIndex = index
-        d = decompileCmd(currentFunc[index])
-        if type(d) == list:
-            other = d[:-1] + other
-            d = d[-1]
-        if ((type(currentFunc[thisIndex]) in [Command, FunctionCallGroup, IfElseIntermediate]) and currentFunc[thisIndex].pushBit) or type(currentFunc[thisIndex]) == Cast:
-            args.append(d)
-        else:
-            other.append(d)
-    for i in range(len(args)):
-        if type(args[i]) == c_ast.If:
-            args[i] = ifToTernaryOp(args[i])
-    other = list(filter(lambda a: a != None, other))
-    return other, args
-
 math_constants = {
     math.e: "M_E",
     math.log2(math.e): "M_LOG2E",
@@ -326,262 +279,65 @@ math_constants = {
     1 / math.sqrt(2): "M_SQRT1_2",
 }
 
-# Recursively decompile from commands to an AST, uses global variable "index" to keep track of position,
-# iterating backwards through the function in order to assign arguments to the things that use them.
-def decompileCmd(cmd):
-    global currentFunc, index, localVars, globalVars, funcNames, xmlInfo
-
-    funcHolder = currentFunc
-
-    if type(cmd) == Label:
-        return None
-    if type(cmd) == Command:
-        c = cmd.command
-        if c in [0x0, 0x1, 0x2, 0x3]: # Useless garbage
-            return None
-        elif c in [0x4, 0x5]: # Jumps
-            pass
-        elif c in [0x6, 0x8]: # Return item
-            other, args = getArgs(1)
-            return other + [c_ast.Return(args[0])]
-        elif c in [0x7, 0x9]: # Return nothing
-            return c_ast.Return()
-        elif c in [0xA, 0xD]: # Push constant
-            if type(cmd.parameters[0]) == ScriptRef:
-                return c_ast.ID(str(cmd.parameters[0]))
-            if type(cmd.parameters[0]) == float:
-                # Check if float is equal to a math constant
-                for m_const in math_constants:
-                    if math.isclose(cmd.parameters[0], m_const, abs_tol=0.0001):
-                        return c_ast.ID(math_constants[m_const])
-            return c_ast.Constant(cmd.parameters[0])
-        elif c == 0xB: # Push variable
-            if cmd.parameters[0] == 0:
-                return localVars[cmd.parameters[1]]
-            else:
-                return globalVars[cmd.parameters[1]]
-        elif c in [0xe, 0xf, 0x10, 0x11, 0x12, 0x16, 0x17, 0x19, 0x1a, 0x1b, 0x25, 0x26, 0x27, 0x28, 0x29, 0x2a, 0x3a, 0x3b, 0x3c, 0x3d, 0x46, 0x47, 0x48, 0x49, 0x4a, 0x4b]:
-            other, args = getArgs(2)
-            return other + [c_ast.BinaryOp(BINARY_OPERATIONS[c], args[1], args[0])]
-        elif c in [0x13, 0x18, 0x2b, 0x3e]: # Negation, bit not, logic not, etc. (Unary Op not applied to variable)
-            other, args = getArgs(1)
-            return other + [c_ast.UnaryOp(UNARY_OPERATIONS[c], args[0])]
-        elif c in [0x14, 0x15, 0x3f, 0x40]: # ++, --, etc. (Unary Op applied to variable)
-            if cmd.parameters[0] == 0:
-                return c_ast.UnaryOp(UNARY_OPERATIONS[c], localVars[cmd.parameters[1]])
-            else:
-                return c_ast.UnaryOp(UNARY_OPERATIONS[c], globalVars[cmd.parameters[1]])
-        elif c in [0x1c, 0x1d, 0x1e, 0x1f, 0x20, 0x21, 0x22, 0x23, 0x24, 0x41, 0x42, 0x43, 0x44, 0x45]: # varset, floatvarset, etc.
-            other, args = getArgs(1)
-            if cmd.parameters[0] == 0:
-                variable = localVars[cmd.parameters[1]]
-            else:
-                variable = globalVars[cmd.parameters[1]]
-            return other + [c_ast.Assignment(ASSIGNMENT_OPERATIONS[c], variable, args[0])]
-        elif c == 0x2c: # printf
-            other, args = getArgs(cmd.parameters[0])
-            return other + [c_ast.FuncCall("printf", c_ast.DeclList(args[::-1]))]
-        elif c == 0x2d: # syscall
-            other, args = getArgs(cmd.parameters[0])
-            syscallInfo = xmlInfo.getSyscall(cmd.parameters[1])
-            if syscallInfo != None:
-                if RepresentsInt(str(args[-1])):
-                    methodInfo = syscallInfo.getMethod(int(str(args[-1]), 0))
-                    if methodInfo != None:
-                        return other + [c_ast.FuncCall(c_ast.StructRef(syscallInfo.name, methodInfo.name), c_ast.DeclList(args[-2::-1]))]
-                return other + [c_ast.FuncCall(syscallInfo.name, c_ast.DeclList(args[::-1]))]
-            return other + [c_ast.FuncCall("sys_%X" % cmd.parameters[1], c_ast.DeclList(args[::-1]))]
-        elif c == 0x30: # set_main
-            other, args = getArgs(cmd.parameters[0] + 1)
-            if type(args[0]) == c_ast.Constant and type(args[0].value) == str:
-                args[0] = c_ast.ID(args[0].value)
-            return other + [c_ast.FuncCall("set_main", c_ast.DeclList(args[0:1] + args[:0:-1]))] #args[0:1] + args[:0:-1] is the first arg then the rest are in opposite order
-        elif c == 0x31: # callFunc3
-            other, args = getArgs(cmd.parameters[0] + 1)
-            if type(args[0]) == c_ast.Constant and type(args[0].value) == str:
-                args[0] = c_ast.ID(args[0].value)
-            return other + [c_ast.FuncCall("callFunc3", c_ast.DeclList(args[0:1] + args[:0:-1]))]
-    elif type(cmd) == FunctionCallGroup:
-        oldFunc = currentFunc
-        oldIndex = index
-
-        currentFunc = cmd
-        index = len(currentFunc) - 2 # (ignore the label that will be at the end)
-        if currentFunc[index].command != 0x2f:
-            raise DecompilerError("Function improperly formatted")
-        cmd = currentFunc[index]
-        other, args = getArgs(cmd.parameters[0] + 1)
-
-        while index > 0:
-            d = decompileCmd(currentFunc[index])
-            if type(d) == list:
-                other = d + other
-            else:
-                other.insert(0, d)
-            index -= 1
-
-        if type(args[0]) == c_ast.ID and not args[0].name in funcNames:
-            args[0] = c_ast.UnaryOp("*", args[0])
-
-        if type(args[0]) == c_ast.Constant and type(args[0].value) == str:
-            args[0] = c_ast.ID(args[0].value)
-
-        currentFunc = oldFunc
-        index = oldIndex
-
-        return other + [c_ast.FuncCall(args[0], c_ast.DeclList(args[:0:-1]))]
-    elif type(cmd) == Cast:
-        other, args = getArgs(1)
-        return other + [c_ast.Cast(cmd.type, args[0])]
-    elif type(cmd) == IfElseIntermediate:
-        beforeIf, args = getArgs(1)
-        if len(args) == 0:
-            return beforeIf
-        ifCondition = args[0]
-        oldFunc = currentFunc
-        oldIndex = index
-        trueStatements = c_ast.Statements()
-        currentFunc = cmd.ifCommands
-        index = len(currentFunc) - 1
-        while index >= 0:
-            d = decompileCmd(currentFunc[index])
-            if type(d) == list:
-                for i in d[::-1]:
-                    if i != None:
-                        trueStatements.insert(0, i)
-            elif d != None:
-                trueStatements.insert(0, d)
-            index -= 1
-        if cmd.elseCommands != None:
-            currentFunc = cmd.elseCommands
-            index = len(currentFunc) - 1
-            falseStatements = c_ast.Statements()
-            while index >= 0:
-                d = decompileCmd(currentFunc[index])
-                if type(d) == list:
-                    for i in d[::-1]:
-                        if i != None:
-                            falseStatements.insert(0, i)
-                elif d != None:
-                    falseStatements.insert(0, d)
-                index -= 1
-        else:
-            falseStatements = None
-        currentFunc = oldFunc
-        index = oldIndex
-        if cmd.isNot:
-            ifCondition = c_ast.UnaryOp("!", ifCondition)
-        return beforeIf + [c_ast.If(ifCondition, trueStatements, falseStatements)]
-    elif type(cmd) == WhileIntermediate:
-        oldFunc = currentFunc
-        oldIndex = index
-        loopStatements = c_ast.Statements()
-        currentFunc = cmd.commands
-        index = len(currentFunc)
-        other, condition = getArgs(1)
-        index -= 1
-        condition = condition[0]
-        for i in other[::-1]:
-            loopStatements.insert(0, i)
-        while index >= 0:
-            d = decompileCmd(currentFunc[index])
-            if type(d) == list:
-                for i in d[::-1]:
-                    if i != None:
-                        loopStatements.insert(0, i)
-            elif d != None:
-                loopStatements.insert(0, d)
-            index -= 1
-        currentFunc = oldFunc
-        index = oldIndex
-        if not cmd.isIfNot:
-            condition = c_ast.UnaryOp("!", condition)
-        if cmd.isDoWhile:
-            return c_ast.DoWhile(condition, loopStatements)
-        else:
-            return c_ast.While(condition, loopStatements)
-    elif type(cmd) == c_ast.Break:
-        return cmd
-
-# Decopmiles the commands of the function and stores the resulting AST in the list s
-def decompileFunc(func, s):
-    global currentFunc, index
-    currentFunc = func
-    currentFunc.cmds = pullOutGroups(pullOutLoops(currentFunc.cmds))
-    index = len(currentFunc) - 1
-    insertPos = len(s)
-    while index >= 0:
-        decompiledCmd = decompileCmd(func[index])
-        if decompiledCmd:
-            if type(decompiledCmd) == list:
-                for i in decompiledCmd[::-1]:
-                    if i != None:
-                        s.insert(insertPos, i)
-            elif decompiledCmd != None:
-                s.insert(insertPos, decompiledCmd)
-        index -= 1
-
-# Takes a function and decompiles it, including setting up local variables
-# returns the decompiled function
-def decompile(func, funcNum):
-    global localVars, funcTypes, allLocalVarTypes
-    f = c_ast.FuncDef(funcTypes[funcNum], func.name, c_ast.DeclList(), c_ast.Statements())
-    #try:
-    # If non-empty function that doesn't start with 0x2
-    if len(func.cmds) != 0 and func.cmds[0].command != 0x2:
-        raise DecompilerError("Script {} doesn't start with a begin".format(func.name))
-    beginCommand = func.cmds[0]
-    argc = beginCommand.parameters[0]
-    varc = beginCommand.parameters[1]
-    localVarTypes = getLocalVarTypes(func, varc)
-    allLocalVarTypes.append(localVarTypes)
-    localVars = []
-    localVarDecls = []
-    for i in range(argc):
-        f.args.append(c_ast.Decl(localVarTypes[i], "arg{}".format(i)))
-        localVars.append(c_ast.ID("arg{}".format(i)))
-    for i in range(varc - argc):
-        localVarDecls.append(c_ast.Decl(localVarTypes[i + argc], "var{}".format(i + argc)))
-        localVars.append(c_ast.ID("var{}".format(i + argc)))
-
-    s = f.statements
-    decompileFunc(func, s)
-
-    # Insert local var declarations at the beginning of the function, in order
-    for i, decl in enumerate(localVarDecls):
-        s.insert(i, decl)
-    #except Exception as e: 
-    #    f.statements = c_ast.Statements([c_ast.Comment("Error occurred while decompiling:\n{}".format(str(e)))])
-    return f
-
 # Gets last object of type Command from list l
 def lastCommand(l):
     for i in l[::-1]:
         if type(i) != Label:
             return i
 
+# Maps each label in commands to its position, used instead of commands.index()
+# so nested regions of the same list can look labels up in constant time
+def getLabelPositions(commands):
+    labelPositions = {}
+    for i, cmd in enumerate(commands):
+        if type(cmd) == Label and not cmd in labelPositions:
+            labelPositions[cmd] = i
+    return labelPositions
+
+# Position of label within commands[start:end], -1 if it isn't in that region
+def findLabel(labelPositions, label, start, end):
+    position = labelPositions.get(label, -1)
+    if position < start or position >= end:
+        return -1
+    return position
+
+# Turns the bounds of a slice taken relative to the region commands[start:end]
+# back into absolute bounds, following the same rules as slicing that region
+def subRegion(start, end, first, last):
+    first, last, _ = slice(first - start, last - start).indices(end - start)
+    return start + first, start + max(first, last)
+
 # Put function calls into a seperate groups
 # this relocates casts into inline objects and puts function calls into their own object
 # so they can be seen as one command with a push bit, also moves control flow into seperate objects
-# to later be decompiled recursively
-def pullOutGroups(commands):
+# to later be decompiled recursively. Only commands[start:end] is looked at, nested regions
+# are passed on as bounds into the same list rather than as copies and the structured
+# result of each region is kept so overlapping else blocks are only built once.
+def pullOutGroups(commands, start=0, end=None, labelPositions=None, structured=None):
+    if end == None:
+        end = len(commands)
+    if labelPositions == None:
+        labelPositions = getLabelPositions(commands)
+    # Regions already structured in this list, shared else blocks get asked for
+    # once per if that jumps into them
+    if structured == None:
+        structured = {}
+    elif (start, end) in structured:
+        return structured[(start, end)]
     newCommands = []
-    i = 0
-    while i < len(commands):
+    i = start
+    while i < end:
         cmd = commands[i]
         if type(cmd) == Command and cmd.command == 0x2e:
-            funCallGroup = []
             tryEnd = cmd.parameters[0]
-            i += 1
-            while commands[i] != tryEnd:
-                funCallGroup.append(commands[i])
-                i += 1
-            funCallGroup.append(tryEnd)
-            temp = pullOutGroups(funCallGroup)
+            tryEndPos = findLabel(labelPositions, tryEnd, i + 1, end)
+            if tryEndPos == -1:
+                raise DecompilerError("Label for try not found at {}".format(cmd.commandPosition))
             funCallGroup = FunctionCallGroup(cmd.pushBit)
-            funCallGroup += temp
+            funCallGroup += pullOutGroups(commands, i + 1, tryEndPos + 1, labelPositions, structured)
             newCommands.append(funCallGroup)
             newCommands.append(tryEnd)
+            i = tryEndPos
         elif type(cmd) == Command and cmd.command in [0x38, 0x39]:
             index = len(newCommands) - 1
             numPushedBack = 0
@@ -596,7 +352,7 @@ def pullOutGroups(commands):
                 index -= 1
         elif type(cmd) == Command and cmd.command in [0x34, 0x35]:
             isIfNot = (cmd.command == 0x35)
-            labelPosition = commands.index(cmd.parameters[0])
+            labelPosition = findLabel(labelPositions, cmd.parameters[0], start, end)
             if labelPosition == -1:
                 raise DecompilerError("Label for if/ifNot not found at {}".format(cmd.commandPosition))
             if labelPosition < i:
@@ -608,15 +364,21 @@ def pullOutGroups(commands):
                 newCommands.append(intermediate)
             # Handle weird edge case, see script_6 of character standard lib
             elif type(commands[labelPosition - 1]) == Command and commands[labelPosition - 1].command in [0x34, 0x35]:
-                badIfLabelPos = commands.index(commands[labelPosition - 1].parameters[0])
-                if type(commands[badIfLabelPos - 1]) == Command and commands[badIfLabelPos - 1].command == 0x36:
-                    badElseLabelPos = commands.index(commands[badIfLabelPos - 1].parameters[0])
-                    intermediate = IfElseIntermediate(pullOutGroups(commands[i + 1:badElseLabelPos+1]), pullOutGroups(commands[labelPosition + 1:badIfLabelPos-1]))
+                badIfLabelPos = findLabel(labelPositions, commands[labelPosition - 1].parameters[0], start, end)
+                if badIfLabelPos == -1:
+                    raise DecompilerError("Label for if/ifNot not found at {}".format(commands[labelPosition - 1].commandPosition))
+                # Index -1 of the region is its last command
+                beforeBadIfLabel = commands[badIfLabelPos - 1 if badIfLabelPos > start else end - 1]
+                if type(beforeBadIfLabel) == Command and beforeBadIfLabel.command == 0x36:
+                    badElseLabelPos = findLabel(labelPositions, beforeBadIfLabel.parameters[0], start, end)
+                    if badElseLabelPos == -1:
+                        raise DecompilerError("Label for else not found")
+                    intermediate = IfElseIntermediate(pullOutGroups(commands, *subRegion(start, end, i + 1, badElseLabelPos + 1), labelPositions, structured), pullOutGroups(commands, *subRegion(start, end, labelPosition + 1, badIfLabelPos - 1), labelPositions, structured))
                     intermediate.pushBit = len(intermediate.ifCommands) > 0 and lastCommand(intermediate.ifCommands).pushBit
                     intermediate.isNot = isIfNot
                     i = badElseLabelPos
                 elif labelPosition == badIfLabelPos:
-                    intermediate = IfElseIntermediate(pullOutGroups(commands[i + 1:labelPosition + 1]))
+                    intermediate = IfElseIntermediate(pullOutGroups(commands, i + 1, labelPosition + 1, labelPositions, structured))
                     intermediate.isNot = isIfNot
                     newCommands.append(intermediate)
                     i = labelPosition
@@ -625,8 +387,8 @@ def pullOutGroups(commands):
                 newCommands.append(intermediate)
             elif type(commands[labelPosition - 1]) == Command and commands[labelPosition - 1].command == 0x36:
                 elseLabel = commands[labelPosition - 1].parameters[0]
-                elseLabelPos = commands.index(elseLabel)
-                if elseLabel == -1:
+                elseLabelPos = findLabel(labelPositions, elseLabel, start, end)
+                if elseLabelPos == -1:
                     raise DecompilerError("Label for else not found")
                 copyElse = False
                 for j in range(i + 1, labelPosition - 1):
@@ -634,76 +396,367 @@ def pullOutGroups(commands):
                         copyElse = True
                         break
                 if copyElse:
-                    intermediate = IfElseIntermediate(pullOutGroups(commands[i + 1:elseLabelPos+1]), pullOutGroups(commands[labelPosition + 1:elseLabelPos+1]))
+                    intermediate = IfElseIntermediate(pullOutGroups(commands, *subRegion(start, end, i + 1, elseLabelPos + 1), labelPositions, structured), pullOutGroups(commands, *subRegion(start, end, labelPosition + 1, elseLabelPos + 1), labelPositions, structured))
                     intermediate.pushBit = len(intermediate.ifCommands) > 0 and lastCommand(intermediate.ifCommands).pushBit
                 else:
-                    intermediate = IfElseIntermediate(pullOutGroups(commands[i + 1:labelPosition - 1]), pullOutGroups(commands[labelPosition + 1:elseLabelPos+1]))
+                    intermediate = IfElseIntermediate(pullOutGroups(commands, i + 1, labelPosition - 1, labelPositions, structured), pullOutGroups(commands, *subRegion(start, end, labelPosition + 1, elseLabelPos + 1), labelPositions, structured))
                     intermediate.pushBit = len(intermediate.ifCommands) > 0 and lastCommand(intermediate.ifCommands).pushBit
                 intermediate.isNot = isIfNot
                 newCommands.append(intermediate)
                 i = elseLabelPos
             else:
-                intermediate = IfElseIntermediate(pullOutGroups(commands[i + 1:labelPosition + 1]))
+                intermediate = IfElseIntermediate(pullOutGroups(commands, i + 1, labelPosition + 1, labelPositions, structured))
                 intermediate.isNot = isIfNot
                 newCommands.append(intermediate)
                 i = labelPosition
         else:
             newCommands.append(cmd)
         i += 1
+    structured[(start, end)] = newCommands
     return newCommands
 
-def pullOutLoops(commands):
+# Pulls loops out of commands[start:end] into WhileIntermediate objects, working
+# backwards from the end so the outermost loop is found first. Loop bodies are
+# handled as regions of the same list, which gets its breaks replaced in place.
+def pullOutLoops(commands, start=0, end=None, labelPositions=None):
+    if end == None:
+        end = len(commands)
+    if labelPositions == None:
+        labelPositions = getLabelPositions(commands)
     newCommands = []
-    i = len(commands) - 1
-    while i >= 0:
+    i = end - 1
+    while i >= start:
         cmd = commands[i]
-        if type(cmd) == Command and cmd.command in [0x34, 0x35] and commands.index(cmd.parameters[0]) < i:
+        labelPosition = -1
+        if type(cmd) == Command and cmd.command in [0x34, 0x35]:
+            labelPosition = findLabel(labelPositions, cmd.parameters[0], start, end)
+            if labelPosition == -1:
+                raise DecompilerError("Label for if/ifNot not found at {}".format(cmd.commandPosition))
+        if labelPosition != -1 and labelPosition < i:
             isIfNot = (cmd.command == 0x35)
-            labelPosition = commands.index(cmd.parameters[0])
-            isDoWhile =  not (type(commands[labelPosition-1]) == Command and
-                              commands[labelPosition-1].command in [4, 5, 54] and
-                              commands[labelPosition-1].parameters[0] in commands[labelPosition:i])
-            if type(commands[i+1]) == Label:
+            # Index -1 of the region is its last command
+            beforeLabel = commands[labelPosition - 1 if labelPosition > start else end - 1]
+            isDoWhile =  not (type(beforeLabel) == Command and
+                              beforeLabel.command in [4, 5, 54] and
+                              findLabel(labelPositions, beforeLabel.parameters[0], labelPosition, i) != -1)
+            if i + 1 < end and type(commands[i+1]) == Label:
                 endLabel = commands[i+1]
                 for j in range(labelPosition, i):
                     if type(commands[j]) == Command and commands[j].command in [0x4, 0x5, 0x36] and commands[j].parameters[0] == endLabel:
                         commands[j] = c_ast.Break()
-            newCommands.insert(0, WhileIntermediate(isDoWhile, pullOutGroups(pullOutLoops(commands[labelPosition:i])), isIfNot))
+            loopCommands = pullOutLoops(commands, labelPosition, i, labelPositions)
+            newCommands.append(WhileIntermediate(isDoWhile, pullOutGroups(loopCommands), isIfNot))
             i = labelPosition + 1
         else:
-            newCommands.insert(0, commands[i])
+            newCommands.append(commands[i])
         i -= 1
+    newCommands.reverse()
     return newCommands
 
 # Takes the global variables and functions and prints them out as C to a file
 def printC(globalVars, funcs, file=None):
+    writer = c_ast.CWriter(file if file != None else sys.stdout)
     for decl in globalVars:
-        print(str(decl) + ";", file=file)
+        writer.write(str(decl) + ";\n")
 
-    print(file=file)
+    writer.write("\n")
 
     for func in funcs:
-        print(func, file=file)
-        print(file=file)
-
-# Attempt to determine return type of each function
-# returns a list of strings representing the return type of each function
-def getFuncTypes(mscFile):
-    global globalVarDecls, allLocalVarTypes, funcNames
-    funcTypes = [None for _ in range(len(mscFile))]
-    numPasses = 0
-    while None in funcTypes and numPasses < 4:
-        numPasses += 1
-        for i, func in enumerate(mscFile):
-            if funcTypes[i] != None:
+        writer.writeNode(func)
+        writer.write("\n\n")
+
+# Holds all of the state for decompiling one MSC file, sessions don't share
+# anything so several can run side by side (e.g. in threads)
+class DecompilerSession:
+    def __init__(self, xmlInfo=None, assumeCharStd=False):
+        self.xmlInfo = xmlInfo if xmlInfo != None else MscXmlInfo()
+        self.assumeCharStd = assumeCharStd
+        self.mscFile = None
+        self.currentFunc = None
+        self.index = 0
+        self.stack = []
+        self.stackPositions = []
+        self.exhausted = False
+        self.localVars = []
+        self.globalVars = []
+        self.globalVarDecls = []
+        self.funcNames = []
+        self.funcTypes = []
+        self.allLocalVarTypes = []
+        self.funcs = []
+
+    # Helper function for decompileCmd which takes the arguments of a command off
+    # self.stack based on their pushbit so they can be used within the original command.
+    # Returns a tuple of lists, the first being commands run in between and the later
+    # being the arguments to use. Leaves self.index at the first position consumed.
+    def getArgs(self, argc):
+        before = []
+        other = []
+        args = []
+        stack = self.stack
+        stackPositions = self.stackPositions
+        while len(args) < argc:
+            if len(stack) > 0:
+                d = stack.pop()
+                cmd = self.currentFunc[stackPositions.pop()]
+                # Values on the stack cover consecutive runs of commands
+                if len(stackPositions) > 0:
+                    self.index = stackPositions[-1] + 1
+                else:
+                    self.index = -1 if self.exhausted else 0
+            elif self.exhausted:
+                break
+            else:
+                # A block that runs out of values gives its last command as one
+                # more, the same as reading index -1 of it
+                self.exhausted = True
+                self.index = -1
+                cmd = self.currentFunc[-1]
+                d = self.decompileCmd(cmd)
+            if type(d) == list:
+                # Statements of an earlier value go before those of a later one
+                before.append(d[:-1])
+                d = d[-1]
+            if ((type(cmd) in [Command, FunctionCallGroup, IfElseIntermediate]) and cmd.pushBit) or type(cmd) == Cast:
+                args.append(d)
+            else:
+                other.append(d)
+        for i in range(len(args)):
+            if type(args[i]) == c_ast.If:
+                args[i] = ifToTernaryOp(args[i])
+        if len(before) > 0:
+            other = [i for statements in before[::-1] for i in statements] + other
+        if len(other) > 0:
+            other = [i for i in other if i != None]
+        return other, args
+
+    # Decompiles commands[0:end] front to back onto a fresh self.stack. Each command
+    # takes the values it uses off the stack and then has its own result pushed, so
+    # the stack ends up holding the results nothing consumed in order, with the
+    # position of each command in self.stackPositions.
+    def liftCommands(self, commands, end=None):
+        self.currentFunc = commands
+        self.stack = []
+        self.stackPositions = []
+        self.exhausted = False
+        if end == None:
+            end = len(commands)
+        for position in range(end):
+            self.liftCommand(position)
+
+    def liftCommand(self, position):
+        self.index = position
+        self.stack.append(self.decompileCmd(self.currentFunc[position]))
+        self.stackPositions.append(position)
+
+    def saveLiftState(self):
+        return (self.currentFunc, self.index, self.stack, self.stackPositions, self.exhausted)
+
+    def restoreLiftState(self, state):
+        self.currentFunc, self.index, self.stack, self.stackPositions, self.exhausted = state
+
+    # Returns the statements left on self.stack in order, skipping any command
+    # before position first
+    def stackStatements(self, first=0):
+        statements = []
+        for position, d in zip(self.stackPositions, self.stack):
+            if position < first:
                 continue
-            hasReturnValue = False
+            if type(d) == list:
+                for i in d:
+                    if i != None:
+                        statements.append(i)
+            elif d != None:
+                statements.append(d)
+        return statements
+
+    # Decompiles a whole block of commands and returns its statements in order
+    def decompileStatements(self, commands):
+        state = self.saveLiftState()
+        self.liftCommands(commands)
+        statements = self.stackStatements()
+        self.restoreLiftState(state)
+        return statements
+
+    # Decompile a command to an AST, taking its arguments from the values the commands
+    # before it left on self.stack. Blocks inside groups, ifs and loops are lifted on a
+    # stack of their own.
+    def decompileCmd(self, cmd):
+        funcHolder = self.currentFunc
+
+        if type(cmd) == Label:
+            return None
+        if type(cmd) == Command:
+            c = cmd.command
+            if c in [0x0, 0x1, 0x2, 0x3]: # Useless garbage
+                return None
+            elif c in [0x4, 0x5]: # Jumps
+                pass
+            elif c in [0x6, 0x8]: # Return item
+                other, args = self.getArgs(1)
+                return other + [c_ast.Return(args[0])]
+            elif c in [0x7, 0x9]: # Return nothing
+                return c_ast.Return()
+            elif c in [0xA, 0xD]: # Push constant
+                if type(cmd.parameters[0]) == ScriptRef:
+                    return c_ast.ID(str(cmd.parameters[0]))
+                if type(cmd.parameters[0]) == float:
+                    # Check if float is equal to a math constant
+                    for m_const in math_constants:
+                        if math.isclose(cmd.parameters[0], m_const, abs_tol=0.0001):
+                            return c_ast.ID(math_constants[m_const])
+                return c_ast.Constant(cmd.parameters[0])
+            elif c == 0xB: # Push variable
+                if cmd.parameters[0] == 0:
+                    return self.localVars[cmd.parameters[1]]
+                else:
+                    return self.globalVars[cmd.parameters[1]]
+            elif c in [0xe, 0xf, 0x10, 0x11, 0x12, 0x16, 0x17, 0x19, 0x1a, 0x1b, 0x25, 0x26, 0x27, 0x28, 0x29, 0x2a, 0x3a, 0x3b, 0x3c, 0x3d, 0x46, 0x47, 0x48, 0x49, 0x4a, 0x4b]:
+                other, args = self.getArgs(2)
+                return other + [c_ast.BinaryOp(BINARY_OPERATIONS[c], args[1], args[0])]
+            elif c in [0x13, 0x18, 0x2b, 0x3e]: # Negation, bit not, logic not, etc. (Unary Op not applied to variable)
+                other, args = self.getArgs(1)
+                return other + [c_ast.UnaryOp(UNARY_OPERATIONS[c], args[0])]
+            elif c in [0x14, 0x15, 0x3f, 0x40]: # ++, --, etc. (Unary Op applied to variable)
+                if cmd.parameters[0] == 0:
+                    return c_ast.UnaryOp(UNARY_OPERATIONS[c], self.localVars[cmd.parameters[1]])
+                else:
+                    return c_ast.UnaryOp(UNARY_OPERATIONS[c], self.globalVars[cmd.parameters[1]])
+            elif c in [0x1c, 0x1d, 0x1e, 0x1f, 0x20, 0x21, 0x22, 0x23, 0x24, 0x41, 0x42, 0x43, 0x44, 0x45]: # varset, floatvarset, etc.
+                other, args = self.getArgs(1)
+                if cmd.parameters[0] == 0:
+                    variable = self.localVars[cmd.parameters[1]]
+                else:
+                    variable = self.globalVars[cmd.parameters[1]]
+                return other + [c_ast.Assignment(ASSIGNMENT_OPERATIONS[c], variable, args[0])]
+            elif c == 0x2c: # printf
+                other, args = self.getArgs(cmd.parameters[0])
+                return other + [c_ast.FuncCall("printf", c_ast.DeclList(args[::-1]))]
+            elif c == 0x2d: # syscall
+                other, args = self.getArgs(cmd.parameters[0])
+                syscallInfo = self.xmlInfo.getSyscall(cmd.parameters[1])
+                if syscallInfo != None:
+                    if RepresentsInt(str(args[-1])):
+                        methodInfo = syscallInfo.getMethod(int(str(args[-1]), 0))
+                        if methodInfo != None:
+                            return other + [c_ast.FuncCall(c_ast.StructRef(syscallInfo.name, methodInfo.name), c_ast.DeclList(args[-2::-1]))]
+                    return other + [c_ast.FuncCall(syscallInfo.name, c_ast.DeclList(args[::-1]))]
+                return other + [c_ast.FuncCall("sys_%X" % cmd.parameters[1], c_ast.DeclList(args[::-1]))]
+            elif c == 0x30: # set_main
+                other, args = self.getArgs(cmd.parameters[0] + 1)
+                if type(args[0]) == c_ast.Constant and type(args[0].value) == str:
+                    args[0] = c_ast.ID(args[0].value)
+                return other + [c_ast.FuncCall("set_main", c_ast.DeclList(args[0:1] + args[:0:-1]))] #args[0:1] + args[:0:-1] is the first arg then the rest are in opposite order
+            elif c == 0x31: # callFunc3
+                other, args = self.getArgs(cmd.parameters[0] + 1)
+                if type(args[0]) == c_ast.Constant and type(args[0].value) == str:
+                    args[0] = c_ast.ID(args[0].value)
+                return other + [c_ast.FuncCall("callFunc3", c_ast.DeclList(args[0:1] + args[:0:-1]))]
+        elif type(cmd) == FunctionCallGroup:
+            state = self.saveLiftState()
+
+            callPosition = len(cmd) - 2 # (ignore the label that will be at the end)
+            if cmd[callPosition].command != 0x2f:
+                raise DecompilerError("Function improperly formatted")
+            self.liftCommands(cmd, callPosition)
+            self.index = callPosition
+            other, args = self.getArgs(cmd[callPosition].parameters[0] + 1)
+
+            # Commands left over before the arguments run first. The first command
+            # of the arguments is repeated as one of them and the first command of
+            # the group is left out.
+            if self.index > 0:
+                self.liftCommand(self.index)
+                other = self.stackStatements(1) + other
+
+            if type(args[0]) == c_ast.ID and not args[0].name in self.funcNames:
+                args[0] = c_ast.UnaryOp("*", args[0])
+
+            if type(args[0]) == c_ast.Constant and type(args[0].value) == str:
+                args[0] = c_ast.ID(args[0].value)
+
+            self.restoreLiftState(state)
+
+            return other + [c_ast.FuncCall(args[0], c_ast.DeclList(args[:0:-1]))]
+        elif type(cmd) == Cast:
+            other, args = self.getArgs(1)
+            return other + [c_ast.Cast(cmd.type, args[0])]
+        elif type(cmd) == IfElseIntermediate:
+            beforeIf, args = self.getArgs(1)
+            if len(args) == 0:
+                return beforeIf
+            ifCondition = args[0]
+            trueStatements = c_ast.Statements(self.decompileStatements(cmd.ifCommands))
+            if cmd.elseCommands != None:
+                falseStatements = c_ast.Statements(self.decompileStatements(cmd.elseCommands))
+            else:
+                falseStatements = None
+            if cmd.isNot:
+                ifCondition = c_ast.UnaryOp("!", ifCondition)
+            return beforeIf + [c_ast.If(ifCondition, trueStatements, falseStatements)]
+        elif type(cmd) == WhileIntermediate:
+            state = self.saveLiftState()
+            self.liftCommands(cmd.commands)
+            self.index = len(cmd.commands)
+            other, condition = self.getArgs(1)
+            condition = condition[0]
+            loopStatements = c_ast.Statements(self.stackStatements() + other)
+            self.restoreLiftState(state)
+            if not cmd.isIfNot:
+                condition = c_ast.UnaryOp("!", condition)
+            if cmd.isDoWhile:
+                return c_ast.DoWhile(condition, loopStatements)
+            else:
+                return c_ast.While(condition, loopStatements)
+        elif type(cmd) == c_ast.Break:
+            return cmd
+
+    # Decopmiles the commands of the function and stores the resulting AST in the list s
+    def decompileFunc(self, func, s):
+        self.currentFunc = func
+        self.currentFunc.cmds = pullOutGroups(pullOutLoops(self.currentFunc.cmds))
+        s.extend(self.decompileStatements(func.cmds))
+
+    # Takes a function and decompiles it, including setting up local variables
+    # returns the decompiled function
+    def decompile(self, func, funcNum):
+        f = c_ast.FuncDef(self.funcTypes[funcNum], func.name, c_ast.DeclList(), c_ast.Statements())
+        #try:
+        # If non-empty function that doesn't start with 0x2
+        if len(func.cmds) != 0 and func.cmds[0].command != 0x2:
+            raise DecompilerError("Script {} doesn't start with a begin".format(func.name))
+        beginCommand = func.cmds[0]
+        argc = beginCommand.parameters[0]
+        varc = beginCommand.parameters[1]
+        localVarTypes = self.allLocalVarTypes[funcNum]
+        self.localVars = []
+        localVarDecls = []
+        for i in range(argc):
+            f.args.append(c_ast.Decl(localVarTypes[i], "arg{}".format(i)))
+            self.localVars.append(c_ast.ID("arg{}".format(i)))
+        for i in range(varc - argc):
+            localVarDecls.append(c_ast.Decl(localVarTypes[i + argc], "var{}".format(i + argc)))
+            self.localVars.append(c_ast.ID("var{}".format(i + argc)))
+
+        s = f.statements
+        self.decompileFunc(func, s)
+
+        # Insert local var declarations at the beginning of the function, in order
+        s[0:0] = localVarDecls
+        #except Exception as e: 
+        #    f.statements = c_ast.Statements([c_ast.Comment("Error occurred while decompiling:\n{}".format(str(e)))])
+        return f
+
+    # Attempt to determine return type of each function
+    # returns a list of strings representing the return type of each function
+    def getFuncTypes(self, mscFile):
+        funcTypes = [None for _ in range(len(mscFile))]
+        for i, func in enumerate(mscFile):
             returnIndices = []
             for j, cmd in enumerate(func):
                 if type(cmd) == Command and cmd.command in [0x6, 0x8]:
                     returnIndices.append(j)
-                    hasReturnValue = True
-            if not hasReturnValue:
+            if len(returnIndices) == 0:
                 funcTypes[i] = "void"
                 continue
 
@@ -720,10 +773,10 @@ def getFuncTypes(mscFile):
                         t = {str : "string", int : "int", float : "float"}[type(func[returnIndex - 1].parameters[0])]
                         setTypeLevel(t, 1)
                     elif c == 0xb and func[returnIndex - 1].parameters[0] == 1:
-                        var = globalVarDecls[func[returnIndex - 1].parameters[1]]
+                        var = self.globalVarDecls[func[returnIndex - 1].parameters[1]]
                         setTypeLevel(var.type, 1)
                     elif c == 0xb and func[returnIndex - 1].parameters[0] == 0:
-                        setTypeLevel(allLocalVarTypes[i][func[returnIndex - 1].parameters[1]], 1)
+                        setTypeLevel(self.allLocalVarTypes[i][func[returnIndex - 1].parameters[1]], 1)
                     elif c in range(0xe, 0x25):
                         setTypeLevel("int", 2)
                     elif c == 0x2d and func[returnIndex - 1].parameters[1] in FLOAT_RETURN_SYSCALLS:
@@ -733,85 +786,447 @@ def getFuncTypes(mscFile):
                     elif c in range(0x46, 0x4c) or c in range(0x25, 0x2c):
                         setTypeLevel("int", 2)
                 elif type(func[returnIndex - 1]) == Label and type(func[returnIndex - 2]) == FunctionCallGroup:
-                    if func[returnIndex - 2][-3].command in [0xA, 0xD] and func[returnIndex - 2][-3].parameters[0] in funcNames:
+                    if func[returnIndex - 2][-3].command in [0xA, 0xD] and func[returnIndex - 2][-3].parameters[0] in self.funcNames:
                         typeConfirmedLevel[func[returnIndex - 2][-3].parameters[0]] = 1
             if not 1 in typeConfirmedLevel.values() and not 2 in typeConfirmedLevel.values():
                 continue
             maxType = max(typeConfirmedLevel.items(), key=operator.itemgetter(1))[0]
             funcTypes[i] = maxType
-    for i in range(len(funcTypes)):
-        if funcTypes[i] == None:
-            funcTypes[i] = "int"
-        elif funcTypes[i] in funcNames:
-            MAX_RECURSION = 10000
-            recursiveLevel = 0
-            while funcTypes[i] in funcNames:
-                recursiveLevel += 1
-                if recursiveLevel > MAX_RECURSION:
-                    break # Prevent an infinite loop by timing out after MAX_RECURSION tries
-                funcTypes[i] = funcTypes[funcNames.index(funcTypes[i])]
-    return funcTypes
 
-def main(args):
-    global globalVars, globalVarDecls, funcTypes, funcNames, allLocalVarTypes, xmlInfo
+        # A function that returns another function's result has that function's
+        # type. Every function depends on at most one other, so the strongly
+        # connected components of these dependencies are plain cycles: follow
+        # each chain once, callee first, and give cycles (and anything left
+        # without evidence) the default int
+        funcIndices = {}
+        for i, name in enumerate(self.funcNames):
+            if not name in funcIndices:
+                funcIndices[name] = i
+        returnTypes = [None for _ in range(len(funcTypes))]
+        for i in range(len(funcTypes)):
+            chain = {}
+            j = i
+            while returnTypes[j] == None and funcTypes[j] in funcIndices and not j in chain:
+                chain[j] = True
+                j = funcIndices[funcTypes[j]]
+            if returnTypes[j] == None and not j in chain:
+                returnTypes[j] = funcTypes[j] if funcTypes[j] != None else "int"
+            t = returnTypes[j] if not j in chain else "int"
+            for k in chain:
+                returnTypes[k] = t
+        return returnTypes
+
+    # Analyzes and decompiles a single MSC file, returns the list of
+    # decompiled functions (also kept in self.funcs for writeC). With
+    # funcJobs > 1 the functions are decompiled in that many processes.
+    def decompileFile(self, path, verbose=False, funcJobs=1):
+        if verbose:
+            print("Analyzing...")
+        self.mscFile = mscsb_disasm(path)
+        if verbose:
+            print("Decompiling...")
+
+        # Gather the variable type evidence of every function up front, the
+        # globals need all of it and each function needs its own locals
+        allVarEvidence = [getVarEvidence(func) for func in self.mscFile]
+        self.globalVarDecls = getGlobalVars(allVarEvidence)
+        if self.assumeCharStd:
+            for g in self.xmlInfo.globals:
+                self.globalVarDecls[g.id].name = g.name
+
+        self.globalVars = [c_ast.ID(decl.name) for decl in self.globalVarDecls]
+        self.funcs = []
+        self.funcTypes = [None for _ in range(len(self.mscFile))]
+
+        # Rename entrypoint function to "main"
+        self.mscFile.getScriptAtLocation(self.mscFile.entryPoint).name = 'main'
+        self.funcNames = []
+        for script in self.mscFile:
+            self.funcNames.append(script.name)
+        if self.assumeCharStd:
+            for f in self.xmlInfo.functions:
+                self.funcNames[f.id] = f.name
+
+        self.allLocalVarTypes = []
+        for func, evidence in zip(self.mscFile, allVarEvidence):
+            varCount = 0
+            if len(func.cmds) != 0 and func.cmds[0].command == 0x2:
+                varCount = func.cmds[0].parameters[1]
+            self.allLocalVarTypes.append(getLocalVarTypes(evidence, varCount))
+        self.funcs = self.decompileFuncs(funcJobs)
+        self.funcTypes = self.getFuncTypes(self.mscFile)
+        for i, func in enumerate(self.funcs):
+            func.type = self.funcTypes[i]
+        return self.funcs
+
+    # Decompiles every script of self.mscFile in order. With jobs > 1 the
+    # scripts are spread over worker processes which each get a copy of the
+    # tables shared between functions, the results are put back in script
+    # order so the output is identical to the serial path.
+    def decompileFuncs(self, jobs=1):
+        if jobs <= 1 or len(self.mscFile) <= 1:
+            return [self.decompile(script, i) for i, script in enumerate(self.mscFile)]
+
+        shared = (self.xmlInfo, self.assumeCharStd, self.globalVars, self.globalVarDecls, self.funcNames, self.funcTypes, self.allLocalVarTypes)
+        tasks = [(i, script) for i, script in enumerate(self.mscFile)]
+        chunkSize = max(1, len(tasks) // (jobs * 4))
+        funcs = []
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_initFuncWorker, initargs=(shared,)) as executor:
+            for i, f, cmds in executor.map(_decompileFuncJob, tasks, chunksize=chunkSize):
+                # getFuncTypes looks at the structured commands afterwards
+                self.mscFile[i].cmds = cmds
+                funcs.append(f)
+        return funcs
+
+    # Returns the decompiled functions as C text, when split is set all
+    # functions before main() go to a separate stdlib text instead (None
+    # otherwise). Returns (C text, stdlib text), writeOutput puts the
+    # #include of the stdlib in front of the C text.
+    def renderC(self, split=False):
+        funcs = list(self.funcs)
+        f = io.StringIO()
+        if split:
+            stdlibFuncs = []
+            while funcs[0].name != "main":
+                stdlibFuncs.append(funcs.pop(0))
+            stdlib = io.StringIO()
+            printC(self.globalVarDecls, stdlibFuncs, stdlib)
+            printC([], funcs, f)
+            return f.getvalue(), stdlib.getvalue()
+        printC(self.globalVarDecls, funcs, f)
+        return f.getvalue(), None
+
+    def writeC(self, outPath, split=False, stdlibName="stdlib.c"):
+        text, stdlibText = self.renderC(split)
+        writeOutput(outPath, text, stdlibText, stdlibName)
+
+# Name of the stdlib file split mode writes next to outPath. A batch can
+# put several files into one directory and their stdlibs differ, so each
+# gets its own there.
+def getStdlibName(outPath, batch=False):
+    if batch:
+        return os.path.splitext(os.path.basename(outPath))[0] + ".stdlib.c"
+    return "stdlib.c"
+
+# Writes C text to outPath and, when there is one, the stdlib text next to
+# it as stdlibName, included from the C text
+def writeOutput(outPath, text, stdlibText=None, stdlibName="stdlib.c"):
+    if stdlibText != None:
+        with open(os.path.join(os.path.dirname(outPath), stdlibName), "w") as f:
+            f.write(stdlibText)
+    with open(outPath, "w") as f:
+        if stdlibText != None:
+            print('#include "{}"'.format(stdlibName), file=f)
+        f.write(text)
+
+# Decompiles a single MSC file with a fresh session and writes the C output
+# to outPath (and stdlibName next to it when split is set). With a result
+# cache an unchanged file is written straight from the cache, returns
+# whether it was.
+def decompileFile(path, outPath, xmlInfo=None, split=False, assumeCharStd=False, verbose=False, funcJobs=1, resultCache=None, stdlibName="stdlib.c"):
+    if resultCache == None:
+        session = DecompilerSession(xmlInfo, assumeCharStd)
+        session.decompileFile(path, verbose, funcJobs)
+        session.writeC(outPath, split, stdlibName)
+        return False
+
+    with open(path, 'rb') as f:
+        key = resultCache.getKey(f.read(), split, assumeCharStd)
+    entry = resultCache.get(key)
+    if entry != None:
+        if verbose:
+            print("Using cached result")
+        writeOutput(outPath, entry[0], entry[1], stdlibName)
+        return True
+    session = DecompilerSession(xmlInfo, assumeCharStd)
+    session.decompileFile(path, verbose, funcJobs)
+    text, stdlibText = session.renderC(split)
+    writeOutput(outPath, text, stdlibText, stdlibName)
+    resultCache.put(key, text, stdlibText)
+    return False
+
+LISTING_BUFFER_SIZE = 1 << 20
+
+# Writes the disassembly listing of an MSC file (the text of str(MscFile)) to
+# outPath, returns the number of commands listed
+def disasmFile(path, outPath):
+    mscFile = MscFile()
+    with open(path, 'rb') as f:
+        mscFile.readFromFile(f, packed=True)
+    with open(outPath, 'w', buffering=LISTING_BUFFER_SIZE) as f:
+        return mscFile.writeListing(f)
+
+# Per-function worker processes keep a session holding the tables shared by
+# every function of the file being decompiled
+_funcWorkerSession = None
 
+def _initFuncWorker(shared):
+    global _funcWorkerSession
+    xmlInfo, assumeCharStd, globalVars, globalVarDecls, funcNames, funcTypes, allLocalVarTypes = shared
+    _funcWorkerSession = DecompilerSession(xmlInfo, assumeCharStd)
+    _funcWorkerSession.globalVars = globalVars
+    _funcWorkerSession.globalVarDecls = globalVarDecls
+    _funcWorkerSession.funcNames = funcNames
+    _funcWorkerSession.funcTypes = funcTypes
+    _funcWorkerSession.allLocalVarTypes = allLocalVarTypes
+
+def _decompileFuncJob(task):
+    i, script = task
+    f = _funcWorkerSession.decompile(script, i)
+    return i, f, script.cmds
+
+# Expands the files, directories and glob patterns given on the command line
+# into a sorted list of (input path, output path) pairs. Files found inside a
+# directory keep their path relative to it so outputs never depend on the
+# order files were found in.
+def collectInputs(patterns, outDir=None, extension='.c'):
+    inputs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() == '.mscsb':
+                        path = os.path.join(root, name)
+                        inputs.append((path, os.path.relpath(path, pattern)))
+        elif glob.has_magic(pattern):
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                if os.path.isfile(path):
+                    inputs.append((path, os.path.basename(path)))
+        else:
+            inputs.append((pattern, os.path.basename(pattern)))
+
+    jobs = []
+    seen = set()
+    for path, relPath in inputs:
+        if os.path.abspath(path) in seen:
+            continue
+        seen.add(os.path.abspath(path))
+        outPath = os.path.splitext(relPath)[0] + extension
+        if outDir != None:
+            outPath = os.path.join(outDir, outPath)
+        jobs.append((path, outPath))
+    return jobs
+
+# Xml info already loaded by this process by path, a server keeps reusing
+# it for as long as the file doesn't change
+_loadedXmlInfo = {}
+
+def loadXmlInfo(xmlPath):
+    if xmlPath == None:
+        return MscXmlInfo()
+    key = getXmlCache(xmlPath)[1]
+    if not xmlPath in _loadedXmlInfo or _loadedXmlInfo[xmlPath][0] != key:
+        _loadedXmlInfo[xmlPath] = (key, MscXmlInfo(xmlPath))
+    return _loadedXmlInfo[xmlPath][1]
+
+# Each worker process loads the xml info once and reuses it for every file
+_workerXmlInfo = None
+_workerResultCache = None
+
+def _initWorker(xmlPath, resultCache=None):
+    global _workerXmlInfo, _workerResultCache
+    _workerXmlInfo = loadXmlInfo(xmlPath)
+    _workerResultCache = resultCache
+
+# Runs one batch job, returns (path, outPath, error message or None, seconds
+# taken, listing line count, whether the result came from the cache, bytes
+# stored in the cache)
+def _decompileJob(job):
+    path, outPath, split, assumeCharStd, listing = job
+    stdlibName = getStdlibName(outPath, batch=True)
+    start = timeit.default_timer()
+    lineCount = 0
+    cached = False
+    storedSize = _workerResultCache.storedSize if _workerResultCache != None else 0
+    try:
+        outDir = os.path.dirname(outPath)
+        if outDir != '':
+            os.makedirs(outDir, exist_ok=True)
+        if listing:
+            lineCount = disasmFile(path, outPath)
+        else:
+            cached = decompileFile(path, outPath, _workerXmlInfo, split, assumeCharStd,
+                                   resultCache=_workerResultCache, stdlibName=stdlibName)
+    except Exception as e:
+        return path, outPath, "{}: {}".format(type(e).__name__, e), timeit.default_timer() - start, lineCount, False, 0
+    if _workerResultCache != None:
+        storedSize = _workerResultCache.storedSize - storedSize
+    return path, outPath, None, timeit.default_timer() - start, lineCount, cached, storedSize
+
+def main(args):
     # Use path passed by argument if it exists,
     # else use the path found from getXmlInfoPath()
     # if no XmlInfo file is found, xmlPath will be None
     # MscXmlInfo(None) (aka filename=None) will be an empty MscXmlInfo object
     xmlPath = args.xmlPath if args.xmlPath != None else getXmlInfoPath()
-    xmlInfo = MscXmlInfo(xmlPath)
-
-    print("Analyzing...")
-    mscFile = mscsb_disasm(args.file)
-    print("Decompiling...")
-
-    globalVarDecls = getGlobalVars(mscFile)
-    if args.assumeCharStd:
-        for g in xmlInfo.globals:
-            globalVarDecls[g.id].name = g.name
-
-    globalVars = [c_ast.ID(decl.name) for decl in globalVarDecls]
-    funcs = []
-    funcTypes = [None for _ in range(len(mscFile))]
-
-    # Rename entrypoint function to "main"
-    mscFile.getScriptAtLocation(mscFile.entryPoint).name = 'main'
-    funcNames = []
-    for script in mscFile:
-        funcNames.append(script.name)
-    if args.assumeCharStd:
-        for f in xmlInfo.functions:
-            funcNames[f.id] = f.name
-
-    allLocalVarTypes = []
-    for i, script in enumerate(mscFile):
-        funcs.append(decompile(script, i))
-    funcTypes = getFuncTypes(mscFile)
-    for i, func in enumerate(funcs):
-        func.type = funcTypes[i]
-
-    if args.split:
-        stdlibFuncs = []
-        while funcs[0].name != "main":
-            stdlibFuncs.append(funcs.pop(0))
-        with open("stdlib.c", "w") as f:
-            printC(globalVarDecls, stdlibFuncs, f)
-        with open(args.filename if args.filename != None else (os.path.basename(os.path.splitext(args.file)[0]) + '.c'), "w") as f:
-            print('#include "stdlib.c"', file=f)
-            printC([], funcs, f)
+    cacheSize = args.cacheSize << 20 if args.cacheSize != None else DEFAULT_RESULT_CACHE_SIZE
+
+    if args.cacheStats:
+        ResultCache(None, cacheSize).printStats()
+        return 0
+    resultCache = None
+    if not args.noCache and not args.disasm:
+        resultCache = ResultCache(xmlPath, cacheSize)
+
+    jobs = collectInputs(args.files, args.outDir, '.txt' if args.disasm else '.c')
+    if args.filename != None:
+        if len(jobs) != 1:
+            raise DecompilerError("-o can only be used when decompiling a single file")
+        jobs = [(jobs[0][0], args.filename)]
+    singleFile = len(jobs) == 1 and len(args.files) == 1 and not os.path.isdir(args.files[0])
+    outPaths = [outPath for _, outPath in jobs]
+    if args.split and not singleFile:
+        outPaths += [os.path.join(os.path.dirname(outPath), getStdlibName(outPath, batch=True)) for outPath in outPaths]
+    if len(set(outPaths)) != len(outPaths):
+        raise DecompilerError("Multiple input files would be written to the same output file, use --outDir with directories instead")
+
+    start = timeit.default_timer()
+    totalSize = sum(os.path.getsize(path) for path, _ in jobs if os.path.isfile(path))
+    if singleFile:
+        # Single file, keep errors as tracebacks
+        lineCount = 0
+        cached = False
+        if args.disasm:
+            lineCount = disasmFile(jobs[0][0], jobs[0][1])
+        else:
+            cached = decompileFile(jobs[0][0], jobs[0][1], loadXmlInfo(xmlPath), args.split, args.assumeCharStd,
+                                   verbose=True, funcJobs=args.funcJobs, resultCache=resultCache)
+        storedSize = resultCache.storedSize if resultCache != None else 0
+        results = [(jobs[0][0], jobs[0][1], None, timeit.default_timer() - start, lineCount, cached, storedSize)]
     else:
-        with open(args.filename if args.filename != None else (os.path.basename(os.path.splitext(args.file)[0]) + '.c'), "w") as f:
-            printC(globalVarDecls, funcs, f)
+        batch = [(path, outPath, args.split, args.assumeCharStd, args.disasm) for path, outPath in jobs]
+        workers = args.jobs if args.jobs != None else (os.cpu_count() or 1)
+        results = []
+        if workers <= 1 or len(batch) <= 1:
+            _initWorker(xmlPath, resultCache)
+            resultIter = map(_decompileJob, batch)
+        else:
+            executor = ProcessPoolExecutor(max_workers=min(workers, len(batch)), initializer=_initWorker, initargs=(xmlPath, resultCache))
+            resultIter = executor.map(_decompileJob, batch)
+        for path, outPath, error, elapsed, lineCount, cached, storedSize in resultIter:
+            if error == None:
+                print("OK      {} -> {} ({:.3f}s{})".format(path, outPath, elapsed, ", cached" if cached else ""))
+            else:
+                print("FAILED  {}: {}".format(path, error))
+            results.append((path, outPath, error, elapsed, lineCount, cached, storedSize))
+        if workers > 1 and len(batch) > 1:
+            executor.shutdown()
+    end = timeit.default_timer()
 
-if __name__ == "__main__":
+    failed = [r for r in results if r[2] != None]
+    if len(results) > 1:
+        print("{} succeeded, {} failed".format(len(results) - len(failed), len(failed)))
+    if resultCache != None:
+        hits = sum(1 for r in results if r[5])
+        resultCache.recordRun(hits, len(results) - len(failed) - hits, sum(r[6] for r in results))
+    elapsed = end - start
+    if args.disasm:
+        lineCount = sum(r[4] for r in results)
+        print('Disassembled {}/{} files ({:.1f} KiB, {} lines) in {:f} seconds ({:.0f} lines/s)'.format(
+            len(results) - len(failed), len(results), totalSize / 1024, lineCount, elapsed,
+            lineCount / elapsed if elapsed > 0 else 0))
+        return 1 if len(failed) > 0 else 0
+    print('Decompiled {}/{} files ({:.1f} KiB) in {:f} seconds ({:.2f} files/s, {:.1f} KiB/s)'.format(
+        len(results) - len(failed), len(results), totalSize / 1024, elapsed,
+        len(results) / elapsed if elapsed > 0 else 0, totalSize / 1024 / elapsed if elapsed > 0 else 0))
+    return 1 if len(failed) > 0 else 0
+
+def buildArgParser():
     parser = ArgumentParser(description="Decompile MSC bytecode to C")
-    parser.add_argument('file', type=str, help='file to decompile')
-    parser.add_argument('-o', dest='filename', help='Filename to output to')
-    parser.add_argument('-s', '--split', action='store_true', help='Split to put all functions before main() into stdlib.c')
+    parser.add_argument('files', type=str, nargs='*', help='files, directories or glob patterns to decompile')
+    parser.add_argument('-o', dest='filename', help='Filename to output to (single file only)')
+    parser.add_argument('-d', '--outDir', dest='outDir', help='Directory to write output files to, directory inputs keep their layout inside it')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, help='Number of worker processes to decompile with (default: number of CPUs)')
+    parser.add_argument('-J', '--funcJobs', dest='funcJobs', type=int, default=1, help='Number of worker processes to decompile the functions of a single file with (default: 1)')
+    parser.add_argument('-s', '--split', action='store_true', help='Split to put all functions before main() into stdlib.c (<name>.stdlib.c for each of several files)')
     parser.add_argument('-x', '--xmlPath', dest='xmlPath', help="Path to load overload MSC xml info")
+    parser.add_argument('--disasm', action='store_true', help='Write a disassembly listing (.txt) instead of decompiling')
     parser.add_argument('-c', '--assumeCharStd', dest='assumeCharStd', action='store_true', help="Assume the MSC binary is a character")
-    start = timeit.default_timer()
-    main(parser.parse_args())
-    end = timeit.default_timer()
-    print('Execution completed in %f seconds' % (end - start))
+    parser.add_argument('--noCache', action='store_true', help='Always decompile instead of reusing results of unchanged files')
+    parser.add_argument('--cacheSize', type=int, help='Size limit of the result cache in MiB (default: {})'.format(DEFAULT_RESULT_CACHE_SIZE >> 20))
+    parser.add_argument('--cacheStats', action='store_true', help='Print result cache statistics and exit')
+    return parser
+
+# Files are only optional for --cacheStats
+def parseArgs(argv=None):
+    parser = buildArgParser()
+    args = parser.parse_args(argv)
+    if len(args.files) == 0 and not args.cacheStats:
+        parser.error("the following arguments are required: files")
+    return args
+
+# Runs one client request (its command line and working directory) the same
+# way main() runs in-process and returns the response with everything it
+# printed. Requests are handled one at a time since they change directory.
+def handleRequest(request):
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    previousCwd = os.getcwd()
+    exitCode = 0
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            os.chdir(request["cwd"])
+            exitCode = main(parseArgs(request["argv"]))
+        except SystemExit as e:
+            exitCode = e.code if isinstance(e.code, int) else (0 if e.code == None else 1)
+        except Exception:
+            traceback.print_exc()
+            exitCode = 1
+        finally:
+            os.chdir(previousCwd)
+    return {"exitCode": exitCode, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+# Keeps this process warm and answers "mscdec.py --client" requests on a
+# Unix domain socket until interrupted
+def serve(socketPath):
+    if os.path.lexists(socketPath):
+        try:
+            mscdec_client.checkSocket(socketPath)
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(socketPath)
+        except ConnectionRefusedError:
+            # Left behind by a server that didn't shut down cleanly
+            os.remove(socketPath)
+        except OSError as e:
+            print("Can't serve on {} ({})".format(socketPath, e), file=sys.stderr)
+            return 1
+        else:
+            print("An mscdec server is already listening on {}".format(socketPath), file=sys.stderr)
+            return 1
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Create the socket accessible to this user only, a chmod after bind
+        # would leave a window where anyone could connect
+        oldUmask = os.umask(0o177)
+        try:
+            server.bind(socketPath)
+        finally:
+            os.umask(oldUmask)
+        server.listen()
+        print("Serving on {}".format(socketPath))
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile('rwb') as f:
+                try:
+                    request = mscdec_client.readMessage(f)
+                    if request != None:
+                        mscdec_client.writeMessage(f, handleRequest(request))
+                except (OSError, ValueError) as e:
+                    print("Dropped a request: {}".format(e), file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if os.path.exists(socketPath):
+            os.remove(socketPath)
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        socketPath, rest = mscdec_client.splitSocketArg(sys.argv[2:])
+        if len(rest) != 0:
+            print("usage: mscdec.py --serve [--socket PATH]", file=sys.stderr)
+            sys.exit(2)
+        sys.exit(serve(socketPath))
+    sys.exit(main(parseArgs()))
@@ -0,0 +1,66 @@
+import json, os, socket, stat, sys
+
+# Thin client for a running "mscdec.py --serve". It only forwards its
+# command line and working directory, so it stays clear of everything the
+# decompiler itself imports. Messages are one JSON object per line:
+#   request:  {"argv": [...], "cwd": "..."}
+#   response: {"exitCode": 0, "stdout": "...", "stderr": "..."}
+
+# MSCDEC_SOCKET, else a socket in the user's runtime directory
+def getSocketPath():
+    if os.getenv('MSCDEC_SOCKET'):
+        return os.getenv('MSCDEC_SOCKET')
+    if os.getenv('XDG_RUNTIME_DIR'):
+        return os.path.join(os.getenv('XDG_RUNTIME_DIR'), 'mscdec.sock')
+    return '/tmp/mscdec-{}.sock'.format(os.getuid())
+
+# Takes a leading "--socket PATH" off argv, returns (socket path, rest of argv)
+def splitSocketArg(argv):
+    if len(argv) >= 2 and argv[0] == '--socket':
+        return argv[1], argv[2:]
+    return getSocketPath(), argv
+
+def writeMessage(f, message):
+    f.write(json.dumps(message).encode('utf-8') + b'\n')
+    f.flush()
+
+# Returns the next message, None when the other side closed the connection
+def readMessage(f):
+    line = f.readline()
+    if len(line) == 0:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+# The /tmp fallback is a predictable name in a directory anyone can write
+# to, so only a socket of this user that nobody else can open (as --serve
+# creates it) is trusted to be an mscdec server
+def checkSocket(socketPath):
+    st = os.lstat(socketPath)
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid() or (st.st_mode & 0o077) != 0:
+        raise PermissionError("{} isn't a socket private to this user".format(socketPath))
+
+# Sends one request to the server at socketPath and returns its response
+def sendRequest(socketPath, request):
+    checkSocket(socketPath)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketPath)
+        with sock.makefile('rwb') as f:
+            writeMessage(f, request)
+            response = readMessage(f)
+    if response == None:
+        raise ConnectionError("mscdec server closed the connection without answering")
+    return response
+
+def main(argv):
+    socketPath, argv = splitSocketArg(argv)
+    try:
+        response = sendRequest(socketPath, {"argv": argv, "cwd": os.getcwd()})
+    except OSError as e:
+        print("Couldn't reach an mscdec server at {} ({}), start one with mscdec.py --serve".format(socketPath, e), file=sys.stderr)
+        return 2
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["exitCode"]
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
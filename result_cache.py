@@ -0,0 +1,180 @@
+from os.path import join, dirname, abspath, exists
+from xml_info import getCacheDir
+import os, marshal, hashlib
+
+# Decompiled C output stored by a hash of everything it depends on: the input
+# bytes, the xml info contents, the options changing the output and the
+# decompiler's own source. Entries are evicted least recently used first
+# once the cache grows past its size limit. The stats file keeps a running
+# total of the entries' size so the directory is only scanned when that
+# total goes over the limit (or isn't known yet).
+
+RESULT_CACHE_VERSION = 1
+DEFAULT_RESULT_CACHE_SIZE = 256 << 20
+
+# Modules whose source affects the decompiled output
+DECOMPILER_MODULES = ['mscdec.py', 'msc.py', 'disasmlib.py', 'ast2str.py', 'xml_info.py']
+
+_decompilerVersion = None
+
+# A digest of the decompiler's source, so editing it invalidates every result
+def getDecompilerVersion():
+    global _decompilerVersion
+    if _decompilerVersion == None:
+        h = hashlib.sha256(str(RESULT_CACHE_VERSION).encode('utf-8'))
+        for name in DECOMPILER_MODULES:
+            path = join(dirname(abspath(__file__)), name)
+            if exists(path):
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+        _decompilerVersion = h.hexdigest()
+    return _decompilerVersion
+
+def getXmlDigest(xmlPath):
+    if xmlPath == None:
+        return None
+    with open(xmlPath, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def getResultCacheDir():
+    return join(getCacheDir(), 'results')
+
+class ResultCache:
+    def __init__(self, xmlPath=None, maxSize=DEFAULT_RESULT_CACHE_SIZE, path=None):
+        self.path = path if path != None else getResultCacheDir()
+        self.maxSize = maxSize
+        self.baseKey = (getDecompilerVersion(), getXmlDigest(xmlPath))
+        # Bytes stored by this process, added to the running total by recordRun
+        self.storedSize = 0
+
+    def getKey(self, data, split, assumeCharStd):
+        h = hashlib.sha256(repr(self.baseKey + (split, assumeCharStd)).encode('utf-8'))
+        h.update(data)
+        return h.hexdigest()
+
+    def getEntryPath(self, key):
+        return join(self.path, key[:2], key)
+
+    # Returns the stored (C text, stdlib.c text or None) of a key, None on a
+    # miss. A hit is marked as the most recently used entry, an entry that
+    # can't be read back as one is removed so the next run stores it again.
+    def get(self, key):
+        entryPath = self.getEntryPath(key)
+        try:
+            with open(entryPath, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            entry = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            entry = None
+        if not (type(entry) == tuple and len(entry) == 2 and type(entry[0]) == str and
+                (entry[1] == None or type(entry[1]) == str)):
+            try:
+                os.remove(entryPath)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(entryPath)
+        except OSError:
+            pass
+        return entry
+
+    # Caching is only an optimization, failing to store a result is ignored
+    def put(self, key, text, stdlibText=None):
+        entryPath = self.getEntryPath(key)
+        try:
+            os.makedirs(dirname(entryPath), exist_ok=True)
+            data = marshal.dumps((text, stdlibText))
+            with open(entryPath + '.%d.tmp' % os.getpid(), 'wb') as f:
+                f.write(data)
+            os.replace(entryPath + '.%d.tmp' % os.getpid(), entryPath)
+            self.storedSize += len(data)
+        except OSError:
+            pass
+
+    # Returns a list of (last use, size, path) of every entry
+    def listEntries(self):
+        entries = []
+        try:
+            subdirs = list(os.scandir(self.path))
+        except OSError:
+            return entries
+        for subdir in subdirs:
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    # Removes the least recently used entries until the cache fits in
+    # maxSize, returns (number of entries removed, size left)
+    def evict(self):
+        entries = self.listEntries()
+        totalSize = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            totalSize -= size
+            removed += 1
+        return removed, totalSize
+
+    def getStatsPath(self):
+        return join(self.path, 'stats.marshal')
+
+    # Returns the (hits, misses, evictions) counted over every run so far and
+    # the running size total, None when it isn't known
+    def readStats(self):
+        try:
+            with open(self.getStatsPath(), 'rb') as f:
+                hits, misses, evictions, totalSize = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return 0, 0, 0, None
+        return hits, misses, evictions, totalSize
+
+    def writeStats(self, hits, misses, evictions, totalSize):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.getStatsPath() + '.%d.tmp' % os.getpid(), 'wb') as f:
+                marshal.dump((hits, misses, evictions, totalSize), f)
+            os.replace(self.getStatsPath() + '.%d.tmp' % os.getpid(), self.getStatsPath())
+        except OSError:
+            pass
+
+    # Adds a run's lookups and the bytes it stored (storedSize of every
+    # process that did the storing) to the stats, evicting when the running
+    # total goes over maxSize. Entries that were overwritten are counted
+    # twice, which only makes the next scan (that resyncs the total) earlier.
+    def recordRun(self, hits, misses, storedSize):
+        oldHits, oldMisses, evictions, totalSize = self.readStats()
+        if totalSize == None or totalSize + storedSize > self.maxSize:
+            removed, totalSize = self.evict()
+            evictions += removed
+        else:
+            totalSize += storedSize
+        self.writeStats(oldHits + hits, oldMisses + misses, evictions, totalSize)
+
+    def printStats(self):
+        entries = self.listEntries()
+        totalSize = sum(size for _, size, _ in entries)
+        hits, misses, evictions, _ = self.readStats()
+        lookups = hits + misses
+        print("Result cache: {}".format(self.path))
+        print("Entries:   {}".format(len(entries)))
+        print("Size:      {:.1f} MiB of {:.1f} MiB".format(totalSize / (1 << 20), self.maxSize / (1 << 20)))
+        print("Hits:      {} ({:.1f}% of {} lookups)".format(hits, 100 * hits / lookups if lookups > 0 else 0, lookups))
+        print("Misses:    {}".format(misses))
+        print("Evictions: {}".format(evictions))
@@ -2,86 +2,166 @@ from xml.etree import ElementTree as ET
 from enum import Enum
 from os.path import exists, abspath, expanduser, join, dirname, realpath
 from sys import platform
-import os
+import os, marshal, hashlib
+
+# Finds labels of a list by id or by name through dictionaries. Like a scan
+# over the list each lookup returns the first label with that id or name.
+# Rebuilt by the getters when the list was replaced or changed length, call
+# rebuild() after renaming or renumbering labels in place.
+class LabelIndex:
+    def __init__(self, labels):
+        self.labels = labels
+        self.rebuild()
+
+    def rebuild(self):
+        self.length = len(self.labels)
+        self.ids = {}
+        self.names = {}
+        for label in self.labels:
+            if not label.id in self.ids:
+                self.ids[label.id] = label
+            if not label.name in self.names:
+                self.names[label.name] = label
+
+    def isCurrent(self, labels):
+        return self.labels is labels and self.length == len(labels)
+
+    def find(self, searchFor):
+        if type(searchFor) == str:
+            return self.names.get(searchFor)
+        elif type(searchFor) == int:
+            return self.ids.get(searchFor)
+
+def getLabelIndex(index, labels):
+    if index == None or not index.isCurrent(labels):
+        return LabelIndex(labels)
+    return index
 
 class VariableLabel:
     def __init__(self, id=None, name=None):
         self.id = id
         self.name = name
         self.methods = []
+        self.methodIndex = None
 
     def getMethod(self, searchFor):
-        if type(searchFor) == str:
-            for method in self.methods:
-                if method.name == searchFor:
-                    return method
-        elif type(searchFor) == int:
-            for method in self.methods:
-                if method.id == searchFor:
-                    return method
+        self.methodIndex = getLabelIndex(self.methodIndex, self.methods)
+        return self.methodIndex.find(searchFor)
 
 class MscXmlInfo:
     def __init__(self, filename=None):
         self.globals = []
         self.functions = []
         self.syscalls = []
+        self.globalIndex = None
+        self.functionIndex = None
+        self.syscallIndex = None
         if filename != None:
             self.read(filename)
 
+    # Loads the labels of an xml info file, through the compiled cache when
+    # it is up to date with the file
     def read(self, filename):
-        labels = ET.parse(filename).getroot()
-        for function in labels.find("functions").findall("function"):
-            self.functions.append(VariableLabel(
-                    int(function.get("id"), 0),
-                    function.get("name")
-                ))
-        for globalNode in labels.find("globals").findall("global"):
-            self.globals.append(VariableLabel(
-                    int(globalNode.get("id"), 0),
-                    globalNode.get("name")
-                ))
-        for syscall in labels.find("syscalls").findall("syscall"):
-            syscallLabel = VariableLabel(
-                        int(syscall.get("id"), 0),
-                        syscall.get("name")
-                    )
-            if syscall.find("methods") != None:
-                for method in syscall.find("methods").findall("method"):
-                    syscallLabel.methods.append(VariableLabel(
-                        int(method.get("id"), 0),
-                        method.get("name")
-                    ))
+        tables = readCachedTables(filename)
+        if tables == None:
+            tables = parseXmlTables(filename)
+            writeCachedTables(filename, tables)
+        functions, globals, syscalls = tables
+        for id, name in functions:
+            self.functions.append(VariableLabel(id, name))
+        for id, name in globals:
+            self.globals.append(VariableLabel(id, name))
+        for id, name, methods in syscalls:
+            syscallLabel = VariableLabel(id, name)
+            for methodId, methodName in methods:
+                syscallLabel.methods.append(VariableLabel(methodId, methodName))
             self.syscalls.append(syscallLabel)
+        self.buildIndices()
+
+    # Indexes the labels by id and name, the getters also do this whenever
+    # one of the lists was replaced or changed length. The methods of a
+    # syscall are indexed the first time getMethod is used on it.
+    def buildIndices(self):
+        self.functionIndex = LabelIndex(self.functions)
+        self.syscallIndex = LabelIndex(self.syscalls)
+        self.globalIndex = LabelIndex(self.globals)
 
     def getFunc(self, searchFor):
-        if type(searchFor) == str:
-            for function in self.functions:
-                if function.name == searchFor:
-                    return function
-        elif type(searchFor) == int:
-            for function in self.functions:
-                if function.id == searchFor:
-                    return function
+        self.functionIndex = getLabelIndex(self.functionIndex, self.functions)
+        return self.functionIndex.find(searchFor)
 
     def getSyscall(self, searchFor):
-        if type(searchFor) == str:
-            for syscall in self.syscalls:
-                if syscall.name == searchFor:
-                    return syscall
-        elif type(searchFor) == int:
-            for syscall in self.syscalls:
-                if syscall.id == searchFor:
-                    return syscall
+        self.syscallIndex = getLabelIndex(self.syscallIndex, self.syscalls)
+        return self.syscallIndex.find(searchFor)
 
     def getGlobal(self, searchFor):
-        if type(searchFor) == str:
-            for globalVar in self.globals:
-                if globalVar.name == searchFor:
-                    return globalVar
-        elif type(searchFor) == int:
-            for globalVar in self.globals:
-                if globalVar.id == searchFor:
-                    return globalVar
+        self.globalIndex = getLabelIndex(self.globalIndex, self.globals)
+        return self.globalIndex.find(searchFor)
+
+# Parses an xml info file into plain tables: a list of (id, name) for the
+# functions and globals and a list of (id, name, methods) for the syscalls
+def parseXmlTables(filename):
+    labels = ET.parse(filename).getroot()
+    functions = []
+    for function in labels.find("functions").findall("function"):
+        functions.append((int(function.get("id"), 0), function.get("name")))
+    globals = []
+    for globalNode in labels.find("globals").findall("global"):
+        globals.append((int(globalNode.get("id"), 0), globalNode.get("name")))
+    syscalls = []
+    for syscall in labels.find("syscalls").findall("syscall"):
+        methods = []
+        if syscall.find("methods") != None:
+            for method in syscall.find("methods").findall("method"):
+                methods.append((int(method.get("id"), 0), method.get("name")))
+        syscalls.append((int(syscall.get("id"), 0), syscall.get("name"), methods))
+    return functions, globals, syscalls
+
+# Bump whenever the layout of the cached tables changes
+XML_CACHE_VERSION = 1
+
+# Directory for the files mscdec keeps between runs, MSCDEC_CACHE_DIR
+# overrides the platform's usual user cache directory
+def getCacheDir():
+    if os.getenv('MSCDEC_CACHE_DIR'):
+        return os.getenv('MSCDEC_CACHE_DIR')
+    if platform.startswith('win'):
+        return join(os.getenv('LOCALAPPDATA') or expanduser('~'), 'mscdec', 'cache')
+    elif platform == 'darwin':
+        return join(expanduser('~/Library/Caches'), 'mscdec')
+    return join(os.getenv('XDG_CACHE_HOME') or expanduser('~/.cache'), 'mscdec')
+
+# The cache file of an xml info file and the key it is only valid for, the
+# key changes along with the file's path, modification time or size
+def getXmlCache(filename):
+    path = abspath(filename)
+    stat = os.stat(path)
+    cachePath = join(getCacheDir(), 'mscinfo-{}.marshal'.format(hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]))
+    return cachePath, (XML_CACHE_VERSION, path, stat.st_mtime_ns, stat.st_size)
+
+# Returns the cached tables of an xml info file, None when there are none
+# or they are out of date
+def readCachedTables(filename):
+    try:
+        cachePath, key = getXmlCache(filename)
+        with open(cachePath, 'rb') as f:
+            cachedKey, tables = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if cachedKey != key:
+        return None
+    return tables
+
+# Caching is only an optimization, failing to write the cache is ignored
+def writeCachedTables(filename, tables):
+    try:
+        cachePath, key = getXmlCache(filename)
+        os.makedirs(dirname(cachePath), exist_ok=True)
+        with open(cachePath + '.%d.tmp' % os.getpid(), 'wb') as f:
+            marshal.dump((key, tables), f)
+        os.replace(cachePath + '.%d.tmp' % os.getpid(), cachePath)
+    except OSError:
+        pass
 
 def getXmlInfoPath():
     # If the user in on a unix system, use $HOME/.mscinfo if it exists